@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# IMDb Relational Dataset Generator
+# Copyright (C) 2012  Jef Van den Brandt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Maintenance of the database used by the generator.
+# Uses the database configuration of imdbmodel.py.
+#
+#   python dbtools.py ratings
+#     (re)builds the side table with the votes, rating and ranks as numbers
+#     run it again after reloading the database with imdbpy2sql
+#   python dbtools.py indexes [--create]
+#     shows the missing indexes and the query plans of the id queries and
+#     bulk loaders of the generator (on the first titles and persons)
+#     --create: creates the missing indexes
+#   python dbtools.py counts [--refresh]
+#     shows the count catalog (computed once, again when the data changes)
+#     --refresh: counts again anyway
+#   python dbtools.py extract FILE [--min-votes N] [--kinds KIND ...]
+#     copies the titles with at least N votes (of the kinds) and everything
+#     they link to into a new SQLite file, use it with SQLDB = "sqlite"
+#     and DBNAME = FILE
+#   python dbtools.py snapshot [DIR]
+#     writes the NumPy snapshot of the titles (see imdbsnapshot.py)
+#   python dbtools.py stats
+#     builds the statistics for the selectivity estimates (see imdbstats.py)
+
+import argparse
+from imdbmodel import getImdbpyInstance
+
+def ratings(args):
+	total = getImdbpyInstance().buildRatingTable()
+	print("Side table title_rating built: %d titles." % total)
+
+def indexes(args):
+	db = getImdbpyInstance()
+	missing = db.missingIndexes()
+	if not len(missing):
+		print("All the advised indexes exist.")
+	for name, columns in missing:
+		table = db.Q[name].table.name
+		print("Missing index on %s(%s)." % (table, ", ".join(columns)))
+	queries = db.advisedQueries()
+	printPlans(db, queries)
+	if args.create and len(missing):
+		for name, columns in missing:
+			print("Creating the index on %s(%s)..." % (
+						db.Q[name].table.name, ", ".join(columns)))
+			db.createIndex(name, columns)
+		print("Query plans with the indexes:")
+		printPlans(db, queries)
+
+def printPlans(db, queries):
+	for description, query, params in queries:
+		print("Query plan of %s:" % description)
+		for line in db.explain(query, params):
+			print("    %s" % line)
+
+def counts(args):
+	db = getImdbpyInstance()
+	if args.refresh:
+		import imdbdb
+		imdbdb.saveCatalog(db.fingerprint(), db.countAll())
+	catalog = db.counts()
+	for group, names in (('titles', db._kind), ('persons', db._role),
+						('companies', db._compType), ('info', db._info)):
+		print("%s:" % group.capitalize())
+		for key, amount in sorted(catalog[group].items()):
+			print("    %-40s %d" % (names.get(key, key), amount))
+	print("Titles with keywords: %d" % catalog['keywords'])
+	print("All persons: %d" % catalog['all persons'])
+	print("All companies: %d" % catalog['all companies'])
+	print("All characters: %d" % catalog['all characters'])
+
+def stats(args):
+	import imdbstats
+	statistics = imdbstats.getStatistics(getImdbpyInstance())
+	for key, stat in sorted(statistics.items()):
+		if isinstance(stat, imdbstats.Histogram):
+			print("%-15s %d titles, %d buckets" % (key, stat.entities, 
+													len(stat.buckets)))
+		else:
+			print("%-15s %d titles, %d values" % (key, stat.entities,
+													len(stat.frequencies)))
+
+def extract(args):
+	db = getImdbpyInstance()
+	kinds = [db._kindRev[kind] for kind in args.kinds or []]
+	rows = db.extract(args.file, args.min_votes, kinds)
+	for table, amount in sorted(rows.items()):
+		print("%-20s %d rows" % (table, amount))
+	print("Use it with SQLDB = \"sqlite\" and DBNAME = \"%s\"." % args.file)
+
+def snapshot(args):
+	import imdbsnapshot
+	from imdbmodel import SNAPSHOT_DIR
+	directory = args.directory or SNAPSHOT_DIR
+	total = imdbsnapshot.buildSnapshot(getImdbpyInstance(), directory)
+	print("Snapshot in %s: %d titles." % (directory, total))
+
+def main():
+	parser = argparse.ArgumentParser(
+				description="Maintenance of the IMDbPY database.")
+	commands = parser.add_subparsers()
+	
+	command = commands.add_parser('ratings', 
+				help="(re)build the votes/rating side table")
+	command.set_defaults(function=ratings)
+	
+	command = commands.add_parser('indexes', 
+				help="show (and create) the missing indexes")
+	command.add_argument('--create', action='store_true',
+				help="create the missing indexes")
+	command.set_defaults(function=indexes)
+	
+	command = commands.add_parser('counts', 
+				help="show the count catalog")
+	command.add_argument('--refresh', action='store_true',
+				help="count again, also when the data didn't change")
+	command.set_defaults(function=counts)
+	
+	command = commands.add_parser('snapshot', 
+				help="write the NumPy snapshot of the titles")
+	command.add_argument('directory', nargs='?',
+				help="directory of the snapshot (SNAPSHOT_DIR by default)")
+	command.set_defaults(function=snapshot)
+	
+	command = commands.add_parser('stats', 
+				help="build the statistics of the attribute values")
+	command.set_defaults(function=stats)
+	
+	command = commands.add_parser('extract', 
+				help="copy a part of the database to a SQLite file")
+	command.add_argument('file', help="the new SQLite file")
+	command.add_argument('--min-votes', type=int,
+				help="only the titles with at least this amount of votes")
+	command.add_argument('--kinds', nargs='+', metavar='KIND',
+				help="only titles of these kinds (movie, tv series,...)")
+	command.set_defaults(function=extract)
+	
+	args = parser.parse_args()
+	args.function(args)
+
+if __name__ == "__main__":
+	main()
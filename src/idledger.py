@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# IMDb Relational Dataset Generator
+# Copyright (C) 2012  Jef Van den Brandt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Set of the (positive) integer ids of the entities that are done. It is a
+# bitmap: one bit per id up to the biggest one, e.g. 400 kB for the 3
+# million titles of IMDb, and membership is a lookup of one bit.
+
+import binascii
+import zlib
+import re
+import unittest
+
+# the set operations work on the bitmap as one (long) number
+def toNumber(bits):
+	if not bits:
+		return 0
+	return long(binascii.hexlify(bytes(bits[::-1])), 16)
+
+def fromNumber(number):
+	digits = "%x" % number
+	return bytearray(binascii.unhexlify("0" * (len(digits) % 2) + digits))[::-1]
+
+class IdLedger(object):
+	# smaller ledgers are merged bit by bit: the union as one number copies
+	# the whole bitmap, even for the few ids of a chunk
+	bitwise_limit = 4096
+
+	def __init__(self, ids=()):
+		self.bits = bytearray()
+		self.count = 0
+		self.update(ids)
+
+	def add(self, eid):
+		index = eid >> 3
+		if index >= len(self.bits): # grow: at least double
+			self.bits.extend(bytearray(max(index + 1, 2 * len(self.bits)) -
+									len(self.bits)))
+		mask = 1 << (eid & 7)
+		if not self.bits[index] & mask:
+			self.bits[index] |= mask
+			self.count += 1
+
+	append = add # ids used to be lists
+
+	def update(self, ids):
+		if isinstance(ids, IdLedger) and len(ids) > self.bitwise_limit:
+			union = self | ids
+			self.bits, self.count = union.bits, union.count
+		else:
+			for eid in ids:
+				self.add(eid)
+
+	extend = update
+
+	def discard(self, eid):
+		index = eid >> 3
+		mask = 1 << (eid & 7)
+		if index < len(self.bits) and self.bits[index] & mask:
+			self.bits[index] &= ~mask
+			self.count -= 1
+
+	def __contains__(self, eid):
+		index = eid >> 3
+		return (index < len(self.bits) and
+				bool(self.bits[index] & (1 << (eid & 7))))
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		"""The ids in ascending order."""
+		for match in re.finditer(b'[^\x00]', self.bits): # skips the zeros
+			index = match.start()
+			byte = self.bits[index]
+			for bit in range(8):
+				if byte & (1 << bit):
+					yield (index << 3) | bit
+
+	def __eq__(self, other):
+		return (isinstance(other, IdLedger) and
+				self.bits.rstrip('\0') == other.bits.rstrip('\0'))
+
+	def __ne__(self, other):
+		return not self == other
+
+	@classmethod
+	def fromNumber(cls, number):
+		ledger = cls()
+		if number:
+			ledger.bits = fromNumber(number)
+			ledger.count = bin(number).count('1')
+		return ledger
+
+	def __or__(self, other):
+		"""Union"""
+		return IdLedger.fromNumber(toNumber(self.bits) | toNumber(other.bits))
+
+	def __and__(self, other):
+		"""Intersection"""
+		return IdLedger.fromNumber(toNumber(self.bits) & toNumber(other.bits))
+
+	def __sub__(self, other):
+		"""Difference"""
+		return IdLedger.fromNumber(toNumber(self.bits) & 
+								~toNumber(other.bits))
+
+	def dumps(self):
+		"""Compressed bitmap (zeros compress well when the ids are sparse)."""
+		return zlib.compress(bytes(self.bits.rstrip('\0')))
+
+	@classmethod
+	def loads(cls, data):
+		return cls.fromNumber(toNumber(bytearray(zlib.decompress(data))))
+
+	def __getstate__(self): # pickle (e.g. from worker processes) as dumps
+		return self.dumps()
+
+	def __setstate__(self, data):
+		loaded = IdLedger.loads(data)
+		self.bits, self.count = loaded.bits, loaded.count
+
+	def __repr__(self):
+		return "IdLedger(%d ids)" % self.count
+
+###############################################################################
+## Some tests #################################################################
+###############################################################################
+
+class TestIdLedger(unittest.TestCase):
+	def test_set(self):
+		ledger = IdLedger([5, 3, 1000, 5])
+		self.assertEqual(len(ledger), 3)
+		self.assertTrue(3 in ledger and 1000 in ledger)
+		self.assertFalse(4 in ledger or 10 ** 9 in ledger)
+		ledger.append(0)
+		ledger.discard(5)
+		ledger.discard(6)
+		self.assertEqual(list(ledger), [0, 3, 1000])
+
+	def test_operations(self):
+		a = IdLedger(range(0, 100, 2))
+		b = IdLedger(range(0, 300, 3))
+		self.assertEqual(list(a | b), sorted(set(a) | set(b)))
+		self.assertEqual(list(a & b), list(range(0, 100, 6)))
+		self.assertEqual(list(a - b), sorted(set(a) - set(b)))
+		self.assertEqual(len(b - a), len(set(b) - set(a)))
+		a.update(b)
+		self.assertEqual(a, IdLedger(set(range(0, 100, 2)) | set(b)))
+
+	def test_merge(self):
+		big = IdLedger(range(0, 3000000, 5))
+		expected = set(big)
+		for ids in (range(1, 300, 7), range(2999990, 3000100)): # bitwise
+			big.update(IdLedger(ids))
+			expected.update(ids)
+		bulk = IdLedger(range(3, 30000, 3)) # as one number
+		self.assertTrue(len(bulk) > IdLedger.bitwise_limit)
+		big.update(bulk)
+		expected.update(bulk)
+		self.assertEqual(len(big), len(expected))
+		self.assertEqual(big, IdLedger(expected))
+
+	def test_serialisation(self):
+		import pickle
+		ledger = IdLedger(range(2000000, 3000000, 7))
+		self.assertTrue(len(ledger.dumps()) < 100000)
+		self.assertEqual(IdLedger.loads(ledger.dumps()), ledger)
+		copy = pickle.loads(pickle.dumps(ledger, 2))
+		self.assertEqual(len(copy), len(ledger))
+		self.assertEqual(copy, ledger)
+
+# when this file is not imported, but ran directly: run test code
+if __name__ == '__main__':
+	suites = list()
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestIdLedger))
+	alltests = unittest.TestSuite(suites)
+
+	unittest.TextTestRunner(verbosity=2).run(alltests)
@@ -146,6 +146,10 @@ class ValueConstraint(AbstractConstraintChecker):
 ## Attribute Mix-ins ##########################################################
 	
 class ImdbAttribute(AbstractAttribute):
+	# True when there is a line of Prolog for each row in the database
+	# (the unique constraint can then be checked by counting the rows)
+	linePerRow = False
+	
 	def __init__(self, *args, **kwargs):
 		super(ImdbAttribute, self).__init__(*args, **kwargs)
 		
@@ -179,6 +183,8 @@ class SimpleFloatMixIn(AbstractAttribute):
 								key, item[self.imdbpykey])
 	
 class SimpleStringListMixIn(AbstractAttribute):
+	linePerRow = True
+	
 	def generateProlog(self, key, item):
 		result_string = ""
 		for element in item[self.imdbpykey]:
@@ -459,6 +465,7 @@ class Runtime(ImdbAttribute): # '1', 'runtimes', '620330'
 	runtime(t100441, 113, 'Portugal', '')."""
 	name = "runtime"
 	imdbpykey = "runtimes"
+	linePerRow = True
 	
 	def generateProlog(self, key, item):
 		result = ""
@@ -566,6 +573,8 @@ def parseTechInfo(text):
 	return kind, data, extra
 
 class TechInfoMixIn(ImdbAttribute):
+	linePerRow = True
+	
 	def generateProlog(self, key, item):
 		result = ""
 		for element in item[self.imdbpykey]:
@@ -828,6 +837,7 @@ class Certificates(ImdbAttribute): # '5', 'certificates', '418839'
 	u'Belgium:KT',"""
 	name = "certificate"
 	imdbpykey = "certificates"
+	linePerRow = True
 	
 	def generateProlog(self, key, item):
 		result = ""
@@ -857,6 +867,7 @@ class SoundMix(ImdbAttribute): # '6', 'sound mix', '385541'
 	"""
 	name = "sound_mix"
 	imdbpykey = "sound mix"
+	linePerRow = True
 	
 	def generateProlog(self, key, item):
 		result = ""
@@ -987,6 +998,7 @@ class ReleaseDates(ImdbAttribute): # '16', 'release dates', '2173855'
 	'USA:27 March 1948::(re-release)'"""
 	name = "release_date"
 	imdbpykey = "release dates"	
+	linePerRow = True
 
 	def generateProlog(self, key, item):
 		res = ""
@@ -1183,6 +1195,7 @@ class Budget(ImdbAttribute): # '105', 'budget', '80764'
 	'FFR 50,000'"""
 	name = "budget"
 	imdbpykey = "budget"
+	linePerRow = True
 	max = 9999999
 	
 	def generateProlog(self, key, item):
@@ -1308,6 +1321,7 @@ class Gross(ImdbAttribute): # '107', 'gross', '130853'
     """
 	name = "gross"
 	imdbpykey = "gross"
+	linePerRow = True
 	
 	def generateProlog(self, key, item):
 		res = ""
@@ -1358,6 +1372,7 @@ class Rentals(ImdbAttribute): # '109', 'rentals', '1819'
 	"""
 	name = "rentals"
 	imdbpykey = "rentals"
+	linePerRow = True
 	
 	def generateProlog(self, key, item):
 		res = ""
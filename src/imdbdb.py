@@ -18,91 +18,983 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 import imdb.parser.sql
+from imdb.parser.sql import merge_roles, re_episodes, _reGroupDict
+from imdb.utils import analyze_name
+from imdb.utils import _last
+from imdb.parser.sql import alchemyadapter
 from imdb.parser.sql.alchemyadapter import getDBTables, IN
-from sqlalchemy import func, INTEGER
-from sqlalchemy.sql import select
-from sqlalchemy.sql.expression import cast
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy import func, INTEGER, FLOAT
+from sqlalchemy import MetaData, Table, Column, Integer, Float, String, Index
+from sqlalchemy.engine import reflection
+from sqlalchemy.engine.base import Compiled
+from sqlalchemy.sql import select, bindparam
+from sqlalchemy.sql.expression import cast, or_, and_, not_, exists, case
+from sqlalchemy.sql.expression import false
+from imdbattr import Constraint
+from random import shuffle
+import threading
+import pickle
+import unittest
+import logging
+import os
 
 # hack to make it work without adjusting IMDbPY
 oldAccessSystem = imdb.parser.sql.IMDbSqlAccessSystem
 
+# connection pool settings, see the POOL_* options in imdbmodel
+poolSettings = {'size': 5, 'overflow': 10, 'timeout': 30, 'recycle': 3600,
+				'ping': True}
+engines = {} # the pooled engine of each database uri
+enginePid = os.getpid() # the process the engines belong to
+engineLock = threading.Lock()
+
+def pingConnection(dbapi, dbapi_connection):
+	"""Health check when a connection leaves the pool. A dropped connection
+	(server restart, timeout) is replaced instead of failing the query.
+	dbapi: the DBAPI module, only its errors mean a dropped connection"""
+	cursor = dbapi_connection.cursor()
+	try:
+		cursor.execute("SELECT 1")
+	except dbapi.Error:
+		raise exc.DisconnectionError()
+	cursor.close()
+
+def pooledEngine(uri, **params):
+	"""Replaces create_engine in the setConnection of IMDbPY: all the access
+	objects (one for each worker) share one engine with a pool of 
+	connections per uri. A forked process never gets the engines of its 
+	parent."""
+	with engineLock:
+		if enginePid != os.getpid():
+			dropEngines()
+		engine = engines.get(uri)
+		if engine is None:
+			if not uri.startswith('sqlite'): # no QueuePool for SQLite
+				params.update(pool_size=poolSettings['size'],
+							max_overflow=poolSettings['overflow'],
+							pool_timeout=poolSettings['timeout'],
+							pool_recycle=poolSettings['recycle'])
+			engine = create_engine(uri, **params)
+			if poolSettings['ping']:
+				event.listen(engine, 'checkout', lambda connection, record, 
+						proxy, dbapi=engine.dialect.dbapi: 
+						pingConnection(dbapi, connection))
+			engines[uri] = engine
+		return engine
+
+inherited = [] # engines (and access objects) of the parent process
+
+def forgetEngines(*objects):
+	"""Makes a forked worker process create its own engines. The ones it 
+	inherited (and the objects that use them) are kept, but never used or 
+	closed: that would close the connections of the parent as well."""
+	with engineLock:
+		inherited.extend(objects)
+		dropEngines()
+
+def dropEngines():
+	"""Moves the engines to inherited (with engineLock held)"""
+	global enginePid
+	inherited.extend(engines.values())
+	engines.clear()
+	enginePid = os.getpid()
+
+alchemyadapter.create_engine = pooledEngine
+
+# count catalogs, see MyIMDbSqlAccessSystem.counts
+catalogFile = "counts.imdb"
+catalogs = {} # the catalog of each database fingerprint
+catalogLock = threading.Lock()
+
+def loadCatalog(fingerprint, filename=None):
+	"""The catalog in the file (catalogFile by default), None when it is
+	missing or when it was made for another fingerprint."""
+	try:
+		with open(filename or catalogFile, "rb") as f:
+			saved, catalog = pickle.load(f)
+	except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+		return None
+	if saved != fingerprint:
+		return None
+	return catalog
+
+def saveCatalog(fingerprint, catalog, filename=None):
+	try:
+		with open(filename or catalogFile, "wb") as f:
+			pickle.dump((fingerprint, catalog), f, pickle.HIGHEST_PROTOCOL)
+	except IOError: # read-only directory: count again next time
+		pass
+
+class IdSampler(object):
+	"""Draws random ids from a table without sorting the whole table
+	with ORDER BY random(). The id range (min-max) is split into blocks that 
+	are visited in a shuffled order. Ids never repeat and every query only 
+	scans a few small id ranges, so each batch costs about the same."""
+	block = 128 # width of an id block
+	
+	def __init__(self, column, minid, maxid):
+		self.column = column
+		self.blocks = list(range(minid // self.block, maxid // self.block + 1))
+		shuffle(self.blocks)
+		self.pending = [] # ids found, but not asked for yet
+		self.ranges = 4 # amount of blocks for the next query
+		
+	def sample(self, query, limit):
+		"""Returns at most limit random ids of the query (a select of the id 
+		column, filters included). Nothing is returned when all the blocks
+		have been visited."""
+		while len(self.pending) < limit and len(self.blocks):
+			todo = self.blocks[-self.ranges:]
+			del self.blocks[-self.ranges:]
+			ranges = [self.column.between(b * self.block, 
+										(b + 1) * self.block - 1) 
+					for b in todo]
+			ids = [r[0] for r in query.where(or_(*ranges)).execute()]
+			shuffle(ids)
+			self.pending.extend(ids)
+			if len(ids) < limit: # sparse results: look in more blocks
+				self.ranges = min(self.ranges * 2, 512)
+		result = self.pending[:limit]
+		del self.pending[:limit]
+		return result
+
 class MyIMDbSqlAccessSystem(imdb.parser.sql.IMDbSqlAccessSystem):
 	
-	def __init__(self, uri, *args, **kwargs):
+	def __init__(self, uri, pool=None, *args, **kwargs):
+		"""pool: settings of the connection pool (see poolSettings), they
+		are used when the first access object connects to the uri"""
+		if pool:
+			poolSettings.update(pool)
 		oldAccessSystem.__init__(self, uri, *args, **kwargs)
+		# setConnection keeps a connection checked out that is never used 
+		# (the queries go through the engine): back to the pool with it
+		self._connection.close()
 		self.Q = {} # all the db tables used in building queries
 		for t in getDBTables(uri):
 			self.Q[t._imdbpyName] = t
+		self.samplers = {} # IdSampler for each table when doing random
+		self.statements = {} # compiled statements for each query shape
+		self.recorded = None # (shape, compiled, params) list, see explain
+		self._ratingTable = None
+		self._ratingSource = None
+		self._hasRatings = None # whether the side table can be used
+		self._counts = None # count catalog, see counts()
 			
-	def addRandom(self, queryString, random=True):
-		"""help function for applying randomness to the result"""
-		if random and self._connection.dbName == "mysql":
-			queryString = queryString.order_by(func.rand())
-		elif random: # postgresql, sqlite
-			queryString = queryString.order_by(func.random())
-		return queryString
+	def sample(self, query, table, limit):
+		"""help function for grabbing random ids, see IdSampler"""
+		sampler = self.samplers.get(table._imdbpyName)
+		if sampler is None:
+			minid, maxid = select([func.min(table.q.id), 
+								func.max(table.q.id)]).execute().fetchone()
+			sampler = IdSampler(table.q.id, minid or 0, maxid or 0)
+			self.samplers[table._imdbpyName] = sampler
+		return sampler.sample(query, limit)
+	
+	def resetSamplers(self):
+		"""Start over with random ids (already returned ids can return)."""
+		self.samplers = {}
+	
+	def runStatement(self, shape, build, **params):
+		"""Executes the cached statement of this query shape, only the 
+		params are bound. The statement is built (function build) and 
+		compiled the first time only.
+		shape: hashable key, everything that changes the SQL must be in it"""
+		compiled = self.statements.get(shape)
+		if compiled is None:
+			compiled = build().compile(bind=self.Q['Title'].table.bind)
+			self.statements[shape] = compiled
+		if self.recorded is not None:
+			self.recorded.append((shape, compiled, params))
+		return self.Q['Title'].table.bind.execute(compiled, params)
+	
+	def boundIn(self, column, name, amount):
+		"""IN clause with amount bound parameters (name0, name1,...), so the 
+		statement is the same for every list of that length"""
+		return IN(column, [bindparam('%s%d' % (name, i)) 
+						for i in range(amount)])
+	
+	def listParams(self, name, values, params=None):
+		"""The params of boundIn for the values (added to params)"""
+		params = dict(params or {})
+		for i, value in enumerate(values):
+			params['%s%d' % (name, i)] = value
+		return params
+	
+	def iterIds(self, query, table, after=0, chunk=1000, random=False):
+		"""help function that yields the ids of the query in lists of
+		chunk ids. The ids come from a server-side cursor in id order, so
+		memory stays flat and the first ids arrive before the query is
+		finished. Random ids are drawn from the IdSampler instead."""
+		if random:
+			ids = self.sample(query, table, chunk)
+			while len(ids):
+				yield ids
+				ids = self.sample(query, table, chunk)
+			return
+		query = query.where(table.q.id > after).order_by(table.q.id)
+		result = query.execution_options(stream_results=True).execute()
+		try:
+			rows = result.fetchmany(chunk)
+			while len(rows):
+				yield [r[0] for r in rows]
+				rows = result.fetchmany(chunk)
+		finally: # also when the generator is closed early
+			result.close()
 	
 	# --- grabbing PKs --------------------------------------------------------
 	
-	def getTitles(self, categories=[1], offset=0, limit=100, 
-				random=False, votes=None):
-		"""Returns title ids"""
+	def titlesQuery(self, categories=[1], constraints=()):
+		"""The query that selects the title ids
+		constraints: (attribute, constraint) pairs that are checked by the
+		database as far as possible, see constraintFilters"""
 		T = self.Q['Title']
-		I = self.Q['MovieInfoIdx']
 		#basic = T._ta_select().where(IN(T.q.kindID, categories))
 		basic = select([T.q.id]).where(IN(T.q.kindID, categories))
-		basic = self.addRandom(basic, random)
-		if votes: # let the db check the amount of votes
-			# not super fast initially,
-			# but huge speedup compared to the program
-			basic = basic.where(T.q.id==I.q.movieID). \
-						where(I.q.infoTypeID==100). \
-						where(cast(I.q.info, INTEGER)>votes)
-		result = basic.offset(offset).limit(limit).execute()
-#		result = T._ta_select(IN(T.q.kindID, categories)).offset(offset).limit(limit).execute()
-		return [r[0] for r in list(result)] # + [616975] 
-
-	def getPersons(self, offset=0, limit=100, random=False):
+		for clause in self.constraintFilters(constraints):
+			basic = basic.where(clause)
+		return basic
+	
+	def iterTitles(self, categories=[1], after=0, chunk=1000, random=False,
+				constraints=()):
+		"""Yields lists of title ids, see iterIds"""
+		return self.iterIds(self.titlesQuery(categories, constraints), 
+						self.Q['Title'], after, chunk, random)
+	
+	def iterPersons(self, after=0, chunk=1000, random=False, constraints=()):
+		"""Yields lists of person ids, see iterIds"""
 		P = self.Q['Name']
 		basic = select([P.q.id])
-		basic = self.addRandom(basic, random)
-		result = basic.offset(offset).limit(limit).execute()
-		return [r[0] for r in list(result)]
-			#CharName
-			
-	def getCompanies(self, offset=0, limit=100, random=False):
+		for clause in self.constraintFilters(constraints, 'Name'):
+			basic = basic.where(clause)
+		return self.iterIds(basic, P, after, chunk, random)
+	
+	def iterCompanies(self, after=0, chunk=1000, random=False):
+		"""Yields lists of company ids, see iterIds"""
 		C = self.Q['CompanyName']
-		basic = select([C.q.id])
-		basic = self.addRandom(basic, random)
-		result = basic.offset(offset).limit(limit).execute()
-		return [r[0] for r in list(result)]
+		return self.iterIds(select([C.q.id]), C, after, chunk, random)
 	
-	def getCharacters(self, offset=0, limit=100, random=False):
+	def iterCharacters(self, after=0, chunk=1000, random=False):
+		"""Yields lists of character ids, see iterIds"""
 		C = self.Q['CharName']
-		basic = select([C.q.id])
-		basic = self.addRandom(basic, random)
-		result = basic.offset(offset).limit(limit).execute()
-		return [r[0] for r in list(result)]
+		return self.iterIds(select([C.q.id]), C, after, chunk, random)
+	
+	# --- constraints in the id query -----------------------------------------
+	
+	# title attributes (imdbpykey) in movie_info_idx, others in movie_info
+	indexKeys = ('votes distribution', 'votes', 'rating', 'top 250 rank', 
+				'bottom 10 rank')
+	# title attributes of which the database can check the range/values
+	rangeKeys = ('votes', 'rating', 'top 250 rank', 'runtimes')
+	valueKeys = ('genres', 'countries', 'languages', 'color info')
+	
+	def constraintFilters(self, constraints, entity='Title'):
+		"""Translates the enabled constraints of the attributes into
+		where clauses for the id query of the entity (Title or Name). 
+		constraints: (attribute, constraint) pairs
+		The clauses let through every title that passes the constraint in 
+		the program, but they can let through a few more, so the program 
+		still checks all the constraints after fetching a title."""
+		return [clause for _attr, _const, clause in 
+				self.constraintClauses(constraints, entity)]
+	
+	def checkedConstraints(self, constraints, entity='Title'):
+		"""The (attribute, constraint) pairs of which constraintFilters 
+		makes a where clause: the id query already checks them."""
+		return [(attr, const) for attr, const, _clause in 
+				self.constraintClauses(constraints, entity)]
+	
+	def constraintClauses(self, constraints, entity='Title'):
+		"""help function: (attribute, constraint, clause) of the enabled
+		constraints the database can check, see constraintFilters"""
+		# a value must be there when its availability constraint is enabled
+		required = set(getattr(attr, 'imdbpykey', None) 
+					for attr, const in constraints if const.enabled and 
+						const.type == Constraint.AVAILABILITY)
+		clauses = []
+		for attr, const in constraints:
+			key = getattr(attr, 'imdbpykey', None)
+			if not const.enabled or key is None:
+				continue
+			clause = None
+			if entity == 'Name':
+				if const.type == Constraint.AVAILABILITY:
+					clause = self.personInfoFilter(key)
+			elif const.type == Constraint.AVAILABILITY:
+				# count the rows if the attribute has a line for each row
+				clause = self.availabilityFilter(key, 
+						const.unique and attr.linePerRow,
+						getattr(attr, 'kind', None))
+			elif const.type == Constraint.RANGE:
+				clause = self.rangeFilter(attr.imdbpykey, const.curMin, 
+						const.curMax, attr.imdbpykey in required)
+			elif const.type == Constraint.VALUES:
+				values = [unicode(v) for v, checked in const.values.items()
+						if checked]
+				clause = self.valuesFilter(attr.imdbpykey, values,
+						attr.imdbpykey in required)
+			if clause is not None:
+				clauses.append((attr, const, clause))
+		return clauses
+	
+	def rangeFilter(self, key, low, high, required=False):
+		"""Clause for a range constraint on the title attribute with this 
+		imdbpykey. None when the database can't check it.
+		Titles without the value pass, unless the value is required.
+		Values that aren't a plain number pass too (like the attributes)."""
+		T = self.Q['Title']
+		if key == 'year':
+			column = T.q.productionYear
+			inrange = column.between(low, high)
+			if required:
+				return inrange
+			return or_(column == None, inrange)
+		if key == 'series years':
+			column = T.q.seriesYears # only a single year can be checked
+			inrange = or_(not_(self.isNumber(column)), 
+						self.toNumber(column).between(low, high))
+			if required:
+				return and_(column != None, inrange)
+			return or_(column == None, inrange)
+		if key not in self.rangeKeys:
+			return None
+		if key in self.ratingColumns and self.hasRatingTable():
+			return self.ratingFilter(key, low, high, required)
+		
+		value = self.infoTable(key).q.info
+		if key == 'runtimes': # [country:]minutes
+			value = self.afterColon(value)
+		if key == 'rating': # the attribute compares int(rating)
+			number = self.toNumber(value, decimal=True)
+			inrange = and_(number >= low, number < high + 1)
+			inrange = or_(not_(self.isNumber(value, decimal=True)), inrange)
+		else:
+			inrange = or_(not_(self.isNumber(value)), 
+						self.toNumber(value).between(low, high))
+		if required:
+			return self.infoExists(key, inrange)
+		return or_(not_(self.infoExists(key)), self.infoExists(key, inrange))
+	
+	def valuesFilter(self, key, values, required=False):
+		"""Clause for a value constraint on the title attribute with this 
+		imdbpykey: one of the values must be there. None when the database 
+		can't check it. Titles without the attribute pass, unless required.
+		A value with a note doesn't count (like the attributes)."""
+		if key not in self.valueKeys:
+			return None
+		I = self.infoTable(key)
+		if len(values):
+			matching = and_(IN(I.q.info, values), 
+							or_(I.q.note == None, I.q.note == u''))
+		else: # nothing checked: only titles without the attribute pass
+			matching = false()
+		if required:
+			return self.infoExists(key, matching)
+		return or_(not_(self.infoExists(key)), self.infoExists(key, matching))
+	
+	def availabilityFilter(self, key, unique=False, kind=None):
+		"""Clause for an availability constraint on the title attribute 
+		with this imdbpykey: the title has rows for it (exactly one row when
+		unique). None when the database can't check it.
+		kind: only tech info rows of this kind (CAM, LAB,...)"""
+		T = self.Q['Title']
+		if key == 'year':
+			return T.q.productionYear != None
+		if key == 'series years':
+			return T.q.seriesYears != None
+		if key == 'keywords':
+			I = self.Q['MovieKeyword']
+			clauses = [I.q.movieID == T.q.id]
+		elif self.infoTable(key) is not None:
+			I = self.infoTable(key)
+			clauses = [I.q.movieID == T.q.id, 
+					I.q.infoTypeID == self._infoRev[key]]
+		else:
+			return None
+		if key == 'tech info' and kind:
+			clauses.append(I.q.info.like(u'%s:%%' % kind))
+		if unique: # correlated count, no GROUP BY over the whole table
+			return select([func.count(I.q.id)]).where(and_(*clauses)) \
+					.as_scalar() == 1
+		return exists(select([I.q.id]).where(and_(*clauses)))
+	
+	def personInfoFilter(self, key):
+		"""Clause for an availability constraint on the person attribute
+		with this imdbpykey. None when the database can't check it."""
+		if key not in self._infoRev:
+			return None
+		P = self.Q['Name']
+		I = self.Q['PersonInfo']
+		return exists(select([I.q.id]).where(I.q.personID == P.q.id)
+					.where(I.q.infoTypeID == self._infoRev[key]))
+	
+	def infoTable(self, key):
+		"""The table with the info rows of the title attribute with this 
+		imdbpykey (None if it isn't an info type)"""
+		if key not in self._infoRev:
+			return None
+		if key in self.indexKeys:
+			return self.Q['MovieInfoIdx']
+		return self.Q['MovieInfo']
+	
+	def infoExists(self, key, *clauses):
+		"""EXISTS clause: the title has an info row of this imdbpykey 
+		(matching the clauses)"""
+		T = self.Q['Title']
+		I = self.infoTable(key)
+		query = select([I.q.id]).where(I.q.movieID == T.q.id)
+		query = query.where(I.q.infoTypeID == self._infoRev[key])
+		for clause in clauses:
+			query = query.where(clause)
+		return exists(query)
+	
+	def dialect(self):
+		return self.Q['Title'].table.bind.dialect.name
+	
+	def isNumber(self, text, decimal=False):
+		"""Clause: the text column holds a plain (unsigned) number"""
+		dialect = self.dialect()
+		if dialect == 'sqlite': # no regular expressions by default
+			chars = u'*[^0-9.]*' if decimal else u'*[^0-9]*'
+			return and_(text != u'', not_(text.op('GLOB')(chars)))
+		pattern = u'^[0-9]+(\\.[0-9]+)?$' if decimal else u'^[0-9]+$'
+		if dialect == 'mysql':
+			return text.op('REGEXP')(pattern)
+		return text.op('~')(pattern)
+	
+	def toNumber(self, text, decimal=False):
+		"""The number in the text column, NULL if it isn't a number.
+		The cast is never done on other text (errors on PostgreSQL)."""
+		return case([(self.isNumber(text, decimal), 
+					cast(text, FLOAT if decimal else INTEGER))])
+	
+	def afterColon(self, text):
+		"""The part of the text column after the first colon"""
+		dialect = self.dialect()
+		if dialect == 'sqlite':
+			position = func.instr(text, u':')
+		elif dialect == 'mysql':
+			position = func.locate(u':', text)
+		else:
+			position = func.strpos(text, u':')
+		return func.substr(text, position + 1)
+	
+	# --- typed side table for the votes, rating and ranks -------------------
+	
+	# imdbpykey: column of the side table
+	ratingColumns = {'votes': 'votes', 'rating': 'rating', 
+					'top 250 rank': 'top_250_rank', 
+					'bottom 10 rank': 'bottom_10_rank'}
+	
+	def ratingTable(self):
+		"""The side table with the votes, rating and ranks of movie_info_idx
+		as numbers (indexed), so ranges don't cast the text of every row."""
+		if self._ratingTable is None:
+			metadata = MetaData(bind=self.Q['Title'].table.bind)
+			self._ratingTable = Table('title_rating', metadata,
+				Column('movie_id', Integer, primary_key=True, 
+					autoincrement=False),
+				Column('votes', Integer, index=True),
+				Column('rating', Float, index=True),
+				Column('top_250_rank', Integer, index=True),
+				Column('bottom_10_rank', Integer, index=True))
+			# the data the side table was built from, see dataFingerprint
+			self._ratingSource = Table('title_rating_source', metadata,
+				Column('fingerprint', String(255)))
+		return self._ratingTable
+	
+	def hasRatingTable(self):
+		"""Whether the side table exists and was built from the current data
+		(see buildRatingTable). imdbpy2sql doesn't touch it, so after a 
+		reload it is ignored until it is built again."""
+		if self._hasRatings is None:
+			self._hasRatings = False
+			if self.ratingTable().exists():
+				saved = None
+				if self._ratingSource.exists():
+					saved = select([self._ratingSource.c.fingerprint]) \
+								.execute().scalar()
+				if saved == self.ratingFingerprint():
+					self._hasRatings = True
+				else:
+					logging.warning("The title_rating table was built from "
+						"other data and isn't used. Build it again with: "
+						"python dbtools.py ratings")
+		return self._hasRatings
+	
+	def ratingFingerprint(self, bind=None):
+		"""dataFingerprint as the text in title_rating_source"""
+		return u",".join(unicode(n) for n in self.dataFingerprint(bind))
+	
+	def saveRatingFingerprint(self, bind=None):
+		"""Marks the side table (on bind) as built from its current data"""
+		S = self._ratingSource
+		S.drop(bind=bind, checkfirst=True)
+		S.create(bind=bind)
+		(bind or S.bind).execute(S.insert(), 
+							fingerprint=self.ratingFingerprint(bind))
+	
+	def buildRatingTable(self, window=10000):
+		"""(Re)builds the side table from movie_info_idx. Run it again
+		after reloading the database with imdbpy2sql, the table isn't 
+		updated automatically. Returns the amount of titles in it.
+		window: amount of movie ids read in one go"""
+		R = self.ratingTable()
+		R.drop(checkfirst=True)
+		R.create()
+		self._hasRatings = False # until it is filled
+		
+		I = self.Q['MovieInfoIdx']
+		types = {} # info type id: (column, conversion)
+		for key, column in self.ratingColumns.items():
+			if key in self._infoRev:
+				types[self._infoRev[key]] = (column, 
+								float if key == 'rating' else int)
+		if not len(types):
+			self.saveRatingFingerprint()
+			self._hasRatings = True
+			return 0
+		maxid = select([func.max(I.q.movieID)]).execute().scalar() or 0
+		
+		total = 0
+		for start in range(0, maxid + 1, window):
+			query = select([I.q.movieID, I.q.infoTypeID, I.q.info])
+			query = query.where(IN(I.q.infoTypeID, types.keys()))
+			query = query.where(I.q.movieID.between(start, start+window-1))
+			rows = {}
+			for mid, infotype, info in query.order_by(I.q.id).execute():
+				row = rows.get(mid)
+				if row is None:
+					row = dict((c, None) for c in self.ratingColumns.values())
+					row['movie_id'] = mid
+					rows[mid] = row
+				column, convert = types[infotype]
+				if row[column] is None: # first row, like IMDbPY
+					try:
+						row[column] = convert(info)
+					except ValueError:
+						pass # not a number: same as missing
+			if len(rows):
+				R.insert().execute(rows.values())
+				total += len(rows)
+		self.saveRatingFingerprint()
+		self._hasRatings = True
+		return total
+	
+	def ratingFilter(self, key, low, high, required=False):
+		"""rangeFilter on the side table: an index range scan"""
+		T = self.Q['Title']
+		R = self.ratingTable()
+		column = R.c[self.ratingColumns[key]]
+		if key == 'rating': # the attribute compares int(rating)
+			inrange = and_(column >= low, column < high + 1)
+			outside = or_(column < low, column >= high + 1)
+		else:
+			inrange = column.between(low, high)
+			outside = or_(column < low, column > high)
+		if required:
+			return exists(select([R.c.movie_id]).where(
+						and_(R.c.movie_id == T.q.id, inrange)))
+		# no value or no row in the side table passes too
+		return not_(exists(select([R.c.movie_id]).where(
+						and_(R.c.movie_id == T.q.id, outside))))
+	
+	# --- indexes -------------------------------------------------------------
+	
+	# (table, columns) the queries of the generator and of IMDbPY need
+	advisedIndexes = [('MovieInfo', ('movie_id', 'info_type_id')),
+					('MovieInfoIdx', ('info_type_id', 'movie_id')),
+					('CastInfo', ('movie_id',)),
+					('CastInfo', ('person_id', 'role_id')),
+					('MovieCompanies', ('company_id',)),
+					('MovieCompanies', ('movie_id',)),
+					('MovieKeyword', ('movie_id',)),
+					('MovieLink', ('movie_id',)),
+					('PersonInfo', ('person_id', 'info_type_id'))]
+	
+	def missingIndexes(self):
+		"""The advised indexes the database doesn't have. An index on more
+		columns that starts with the same columns is good too."""
+		inspector = reflection.Inspector.from_engine(
+											self.Q['Title'].table.bind)
+		missing = []
+		for name, columns in self.advisedIndexes:
+			existing = inspector.get_indexes(self.Q[name].table.name)
+			for index in existing:
+				if tuple(index['column_names'][:len(columns)]) == columns:
+					break
+			else:
+				missing.append((name, columns))
+		return missing
+	
+	def createIndex(self, name, columns):
+		"""Creates an advised index (can take a while on big tables)"""
+		table = self.Q[name].table
+		index = Index('gen_%s_%s' % (table.name, '_'.join(columns)),
+					*[table.c[column] for column in columns])
+		index.create()
+	
+	def advisedQueries(self, sample=50):
+		"""The queries of the generator that need the advised indexes, as 
+		(description, statement, params) tuples: the id queries of iterTitles
+		and iterPersons with a filter of each kind, and the statements 
+		getMoviesBulk, getEdges and getPersonsFast run for the first sample
+		titles and persons."""
+		T = self.Q['Title']
+		P = self.Q['Name']
+		queries = []
+		filters = [('votes range', self.rangeFilter('votes', 1000, 10**7)),
+				('genres values', self.valuesFilter('genres', [u'Drama'])),
+				('keywords availability', 
+					self.availabilityFilter('keywords')),
+				('unique tech info', 
+					self.availabilityFilter('tech info', True, 'CAM'))]
+		for description, clause in filters:
+			query = self.titlesQuery().where(clause)
+			queries.append(('titles with %s' % description, 
+						query.where(T.q.id > 0).order_by(T.q.id), None))
+		query = select([P.q.id]).where(self.personInfoFilter('birth name'))
+		queries.append(('persons with birth name', 
+						query.where(P.q.id > 0).order_by(P.q.id), None))
+		
+		titles = [r[0] for r in select([T.q.id]).order_by(T.q.id)
+									.limit(sample).execute()]
+		persons = [r[0] for r in select([P.q.id]).order_by(P.q.id)
+									.limit(sample).execute()]
+		links = set(self._role.values()) | set(self._compType.values()) | \
+				set(self._link.values()) | set(['cast'])
+		self.recorded = []
+		try:
+			self.getMoviesBulk(titles, cast=True, companies=True)
+			self.getEdges(titles, links)
+			self.getPersonsFast(persons)
+			recorded = self.recorded
+		finally:
+			self.recorded = None
+		for shape, compiled, params in recorded:
+			queries.append((shape[0], compiled, params))
+		return queries
+	
+	def explain(self, query, params=None):
+		"""Returns the query plan of the query (a select or a compiled 
+		statement with its params) as a list of lines"""
+		engine = self.Q['Title'].table.bind
+		compiled = query
+		if not isinstance(query, Compiled):
+			compiled = query.compile(bind=engine)
+		params = compiled.construct_params(params)
+		if compiled.positional:
+			params = [params[key] for key in compiled.positiontup]
+		prefix = 'EXPLAIN '
+		if engine.dialect.name == 'sqlite':
+			prefix = 'EXPLAIN QUERY PLAN '
+		result = engine.execute(prefix + unicode(compiled), params)
+		return [' '.join(unicode(v) for v in row) for row in result]
+	
+	# --- local SQLite extract ------------------------------------------------
+	
+	# tables that are copied completely
+	typeTables = ('KindType', 'InfoType', 'RoleType', 'CompanyType', 
+				'CompCastType', 'LinkType')
+	
+	def extractTitles(self, minVotes=None, kinds=None):
+		"""The ids of the titles of the kind ids (all kinds when None) with 
+		at least minVotes votes (any amount when None)"""
+		T = self.Q['Title']
+		I = self.Q['MovieInfoIdx']
+		query = select([T.q.id])
+		if kinds:
+			query = query.where(IN(T.q.kindID, kinds))
+		if minVotes is not None:
+			query = query.where(exists(select([I.q.id])
+						.where(I.q.movieID == T.q.id)
+						.where(I.q.infoTypeID == self._infoRev['votes'])
+						.where(self.isNumber(I.q.info))
+						.where(self.toNumber(I.q.info) >= minVotes)))
+		return set([r[0] for r in query.execute()])
+	
+	def linkedIds(self, column, where, ids, chunk=500):
+		"""The values (ids) of the column in the rows of which the where 
+		column is one of the ids"""
+		result = set()
+		ids = sorted(ids)
+		for i in range(0, len(ids), chunk):
+			query = select([column]).where(IN(where, ids[i:i + chunk]))
+			result.update([r[0] for r in query.execute() if r[0] is not None])
+		return result
+	
+	def copyRows(self, target, table, column, ids, chunk=500, keep=None):
+		"""Copies the rows of the table of which the column is one of the
+		ids to the target connection. Returns the amount of rows.
+		keep: function that tells whether a row (dict) is copied"""
+		copied = 0
+		ids = sorted(ids)
+		for i in range(0, len(ids), chunk):
+			query = table.select().where(IN(column, ids[i:i + chunk]))
+			rows = [dict(row) for row in query.execute()]
+			if keep is not None:
+				rows = [row for row in rows if keep(row)]
+			if len(rows):
+				target.execute(table.insert(), rows)
+				copied += len(rows)
+		return copied
+	
+	def extract(self, filename, minVotes=None, kinds=None, chunk=500):
+		"""Copies a part of the database to a new, indexed SQLite file with 
+		the same schema. All the data is copied of:
+		 - the titles of the kind ids with at least minVotes votes
+		 - the titles they are linked to (movie_link)
+		 - their persons, characters, companies and keywords
+		The filmography of these persons, characters and companies is 
+		copied too (only the title rows), just like the series of all the
+		titles. A diagram that only accepts titles with at least minVotes 
+		votes gives the same output on the file, for one level of links.
+		The file only appears once the copy is complete.
+		Returns a dict with the amount of rows of each table."""
+		if os.path.exists(filename):
+			raise IOError("%s already exists." % filename)
+		Q = self.Q
+		T = Q['Title']
+		C = Q['CastInfo']
+		M = Q['MovieCompanies']
+		K = Q['MovieKeyword']
+		L = Q['MovieLink']
+		titles = self.extractTitles(minVotes, kinds)
+		titles |= self.linkedIds(L.q.linkedMovieID, L.q.movieID, titles, 
+								chunk)
+		persons = self.linkedIds(C.q.personID, C.q.movieID, titles, chunk)
+		characters = self.linkedIds(C.q.personRoleID, C.q.movieID, titles,
+									chunk)
+		companies = self.linkedIds(M.q.companyID, M.q.movieID, titles, chunk)
+		keywords = self.linkedIds(K.q.keywordID, K.q.movieID, titles, chunk)
+		
+		# the filmographies: the other titles and the persons of characters
+		filmography = self.linkedIds(C.q.movieID, C.q.personID, persons, 
+									chunk)
+		filmography |= self.linkedIds(C.q.movieID, C.q.personRoleID, 
+									characters, chunk)
+		filmography |= self.linkedIds(M.q.movieID, M.q.companyID, companies,
+									chunk)
+		names = persons | self.linkedIds(C.q.personID, C.q.personRoleID, 
+										characters, chunk)
+		filmography |= titles
+		series = self.linkedIds(T.q.episodeOfID, T.q.id, filmography, chunk)
+		while not series <= filmography:
+			filmography |= series
+			series = self.linkedIds(T.q.episodeOfID, T.q.id, series, chunk)
+		
+		# (table, column, ids) of the rows to copy
+		copies = [(T, T.q.id, filmography),
+				(Q['Name'], Q['Name'].q.id, names),
+				(Q['CharName'], Q['CharName'].q.id, characters),
+				(Q['CompanyName'], Q['CompanyName'].q.id, companies),
+				(Q['Keyword'], Q['Keyword'].q.id, keywords),
+				(Q['AkaName'], Q['AkaName'].q.personID, persons),
+				(Q['PersonInfo'], Q['PersonInfo'].q.personID, persons),
+				(M, M.q.companyID, companies)]
+		for name in ('AkaTitle', 'CompleteCast', 'MovieKeyword', 
+					'MovieInfo', 'MovieInfoIdx'):
+			copies.append((Q[name], Q[name].q.movieID, titles))
+		
+		# written under another name: no half-written file on a failure
+		partial = filename + '.part'
+		if os.path.exists(partial): # left by an extract that was killed
+			os.remove(partial)
+		engine = create_engine('sqlite:///%s' % partial)
+		connection = engine.connect()
+		try:
+			transaction = connection.begin()
+			result = {}
+			for ta in Q.values():
+				ta.table.create(bind=connection)
+			for name in self.typeTables:
+				rows = [dict(row) for row in Q[name].table.select().execute()]
+				connection.execute(Q[name].table.insert(), rows)
+				result[Q[name].table.name] = len(rows)
+			for ta, column, ids in copies:
+				result[ta.table.name] = self.copyRows(connection, ta.table, 
+													column, ids, chunk)
+			# the cast of the persons and the characters (once)
+			result[C.table.name] = self.copyRows(connection, C.table, 
+							C.q.personID, persons, chunk)
+			result[C.table.name] += self.copyRows(connection, C.table, 
+							C.q.personRoleID, characters, chunk,
+							lambda row: row['person_id'] not in persons)
+			# only links to copied titles (get_movie needs both)
+			result[L.table.name] = self.copyRows(connection, L.table, 
+							L.q.movieID, titles, chunk, 
+							lambda row: row['linked_movie_id'] in filmography)
+			hasRatings = self.hasRatingTable()
+			if hasRatings:
+				R = self.ratingTable()
+				R.create(bind=connection)
+				result[R.name] = self.copyRows(connection, R, R.c.movie_id, 
+											titles, chunk)
+		
+			# the indexes of imdbpy2sql and the advised ones
+			indexes = []
+			for ta in Q.values():
+				for col in ta._imdbpySchema.cols:
+					if col.index:
+						indexes.append(('%s_%s' % (ta.table.name, col.index), 
+									ta.table.name, (ta.colMap[col.name],)))
+			for name, columns in self.advisedIndexes:
+				table = Q[name].table.name
+				indexes.append(('gen_%s_%s' % (table, '_'.join(columns)), 
+								table, columns))
+			for index, table, columns in indexes: # createIndex adds to table
+				connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' 
+									% (index, table, ', '.join(columns)))
+			if hasRatings: # built from the copied data
+				self.saveRatingFingerprint(connection)
+			transaction.commit()
+		except:
+			connection.close()
+			engine.dispose()
+			os.remove(partial)
+			raise
+		connection.close()
+		engine.dispose()
+		os.rename(partial, filename)
+		return result
 	
 	# --- grabbing count ------------------------------------------------------
-			
+	
+	# tables whose highest id tells whether the database changed
+	countedTables = ('Title', 'Name', 'CompanyName', 'CharName', 'CastInfo',
+					'MovieCompanies', 'MovieInfo', 'MovieInfoIdx', 
+					'MovieKeyword', 'PersonInfo')
+	
+	def fingerprint(self):
+		"""Identifies the database and its contents: the connection (without
+		the password) and the dataFingerprint."""
+		url = self.Q['Title'].table.bind.url
+		return ((url.drivername, url.host, url.port, url.database) + 
+				self.dataFingerprint())
+	
+	def dataFingerprint(self, bind=None):
+		"""The highest id of the counted tables (on bind, the database by
+		default). Reloading the data with imdbpy2sql changes it."""
+		maxids = [select([func.max(self.Q[name].q.id)]).as_scalar()
+				for name in self.countedTables]
+		bind = bind or self.Q['Title'].table.bind
+		return tuple(bind.execute(select(maxids)).fetchone())
+	
+	def counts(self, build=True):
+		"""The count catalog (see countAll). It is computed once and kept 
+		in catalogFile, until the fingerprint of the database changes.
+		build: False returns None instead of counting"""
+		if self._counts is None:
+			fingerprint = self.fingerprint()
+			with catalogLock: # one thread does the counting
+				catalog = catalogs.get(fingerprint)
+				if catalog is None:
+					catalog = loadCatalog(fingerprint)
+				if catalog is None:
+					if not build:
+						return None
+					catalog = self.countAll()
+					saveCatalog(fingerprint, catalog)
+				catalogs[fingerprint] = catalog
+			self._counts = catalog
+		return self._counts
+	
+	def countAll(self):
+		"""Counts everything in one go (this takes a while):
+		titles per kind id, persons per role id, companies per company type
+		id, titles per info type id (also keywords), persons per person info 
+		type id, all persons, all companies and all characters."""
+		def grouped(group, counted):
+			query = select([group, func.count(counted)]).group_by(group)
+			return dict([(k, int(n)) for k, n in query.execute()])
+		def total(table):
+			return int(select([func.count(table.q.id)]).scalar())
+		
+		T = self.Q['Title']
+		C = self.Q['CastInfo']
+		M = self.Q['MovieCompanies']
+		PI = self.Q['PersonInfo']
+		MK = self.Q['MovieKeyword']
+		catalog = {'titles': grouped(T.q.kindID, T.q.id),
+				'persons': grouped(C.q.roleID, C.q.personID.distinct()),
+				'companies': grouped(M.q.companyTypeID, 
+									M.q.companyID.distinct()),
+				'info': {},
+				'person info': grouped(PI.q.infoTypeID, 
+									PI.q.personID.distinct()),
+				'keywords': int(select([func.count(MK.q.movieID.distinct())])
+								.scalar()),
+				'all persons': total(self.Q['Name']),
+				'all companies': total(self.Q['CompanyName']),
+				'all characters': total(self.Q['CharName'])}
+		for table in (self.Q['MovieInfo'], self.Q['MovieInfoIdx']):
+			for infotype, n in grouped(table.q.infoTypeID, 
+									table.q.movieID.distinct()).items():
+				catalog['info'][infotype] = catalog['info'].get(infotype, 0) + n
+		return catalog
+	
+	def valueFrequencies(self, key, noted=True):
+		"""{value: amount of titles} of the title attribute with this 
+		imdbpykey (the year or an info type), with one GROUP BY.
+		noted: also count the values with a note (never in a value 
+		constraint). Empty for other keys."""
+		if key == 'year':
+			T = self.Q['Title']
+			query = select([T.q.productionYear, func.count(T.q.id)]) \
+						.where(T.q.productionYear != None)
+			query = query.group_by(T.q.productionYear)
+		elif self.infoTable(key) is not None:
+			I = self.infoTable(key)
+			query = select([I.q.info, func.count(I.q.movieID.distinct())])
+			query = query.where(I.q.infoTypeID == self._infoRev[key])
+			if not noted:
+				query = query.where(or_(I.q.note == None, I.q.note == u''))
+			query = query.group_by(I.q.info)
+		else:
+			return {}
+		return dict([(value, int(n)) for value, n in query.execute()])
+	
 	def getTitlesCount(self, categories=[1]):
 		"""Returns the amount of possible titles for a given category"""
-		T = self.Q['Title']
-		#return func.count(T.q.id).scalar()
-		return select('*').where(IN(T.q.kindID,
-									categories)).alias().count().scalar()
+		titles = self.counts()['titles']
+		return sum([titles.get(kind, 0) for kind in categories])
 	
-	def getCompaniesCount(self):
-		pass
+	def getPersonsCount(self, roles=None):
+		"""The amount of persons with one of the role ids (a person with more
+		roles is counted for each of them), all persons when None."""
+		if roles is None:
+			return self.counts()['all persons']
+		persons = self.counts()['persons']
+		return sum([persons.get(role, 0) for role in roles])
+	
+	def getCompaniesCount(self, types=None):
+		"""The amount of companies with one of the company type ids (counted
+		for each type), all companies when None."""
+		if types is None:
+			return self.counts()['all companies']
+		companies = self.counts()['companies']
+		return sum([companies.get(ctype, 0) for ctype in types])
+	
+	def getCharactersCount(self):
+		return self.counts()['all characters']
+	
+	def getAvailableCount(self, key):
+		"""The amount of titles that have a value for the imdbpykey (info
+		type or keywords), None for other keys."""
+		if key == 'keywords':
+			return self.counts()['keywords']
+		if key not in self._infoRev:
+			return None
+		return self.counts()['info'].get(self._infoRev[key], 0)
 	
 	def getCompany(self, companyid):
 		"""Return a company based on the ID without any further links.
 		Used to speed up the generation process."""
 		C = self.Q['CompanyName']
-		query = select([C.q.id, C.q.name, C.q.countryCode])
-		query = query.where(C.q.id == companyid)
-		cid, name, country = query.execute().fetchone()
+		build = lambda: select([C.q.id, C.q.name, C.q.countryCode]) \
+							.where(C.q.id == bindparam('companyid'))
+		cid, name, country = self.runStatement(('company',), build,
+										companyid=companyid).fetchone()
 		result = imdb.Company.Company(companyID=cid, 
 									  data={"country": country, "name": name,
 									  'distributors': [None],
@@ -110,7 +1002,1063 @@ class MyIMDbSqlAccessSystem(imdb.parser.sql.IMDbSqlAccessSystem):
 									  'special effects companies': [None],
 		                              'miscellaneous companies': [None]})
 		return result
+	
+	def getCharacterFast(self, characterid, filmography=False):
+		"""Return a character based on the ID, see getCharactersFast."""
+		return self.getCharactersFast([characterid], filmography)[characterid]
+	
+	def getPersonFast(self, personid):
+		"""Return a person based on the ID without the filmography.
+		Used to speed up the generation process, see getPersonsFast."""
+		return self.getPersonsFast([personid])[personid]
+	
+	# --- grabbing data in bulk -----------------------------------------------
+	
+	def movieData(self, title, kind, year, index, season, episode, series):
+		"""The data of a title like IMDbPY's get_movie_data (for lists of
+		titles, without the 'episode of')"""
+		data = {'title': title, 'kind': self._kind[kind]}
+		for key, value in (('year', year), ('imdbIndex', index),
+						('season', season), ('episode', episode)):
+			if value is not None:
+				data[key] = value
+		if series is not None:
+			data['series years'] = unicode(series)
+		return data
+	
+	def seriesOf(self, ids):
+		"""Returns {id: Movie} for the series ids ('episode of' of the 
+		episodes, used to sort the titles like IMDbPY)"""
+		T = self.Q['Title']
+		ids = [i for i in ids if i is not None]
+		series = {}
+		if len(ids):
+			query = lambda: select([T.q.id, T.q.title, T.q.kindID, 
+						T.q.productionYear, T.q.imdbIndex, T.q.seasonNr,
+						T.q.episodeNr, T.q.seriesYears]) \
+						.where(self.boundIn(T.q.id, 'id', len(ids)))
+			for row in self.runStatement(('series', len(ids)), query,
+										**self.listParams('id', ids)):
+				series[row[0]] = imdb.Movie.Movie(movieID=row[0],
+						data=self.movieData(*row[1:]), accessSystem='sql')
+		return series
+	
+	def getCompaniesBulk(self, ids, classes=(), links=()):
+		"""Returns a dict with a Company object for each of the given company
+		ids, with only the company types (imdbpyType) that are needed:
+		classes: a [None] list when the company has titles of that type 
+		(enough for the class constraint)
+		links: the sorted list of titles of that type, like get_company
+		The other types are left out, so a distributor with 40k titles 
+		costs nothing when only the production companies are wanted."""
+		ids = list(ids)
+		if not len(ids):
+			return {}
+		C = self.Q['CompanyName']
+		n = len(ids)
+		params = self.listParams('id', ids)
+		
+		res = {}
+		query = lambda: select([C.q.id, C.q.name, C.q.countryCode]) \
+						.where(self.boundIn(C.q.id, 'id', n))
+		for cid, name, country in self.runStatement(('companies', n), query,
+													**params):
+			res[cid] = {'name': name}
+			if country is not None:
+				res[cid]['country'] = country
+		
+		typeids = dict((name, tid) for tid, name in self._compType.items())
+		M = self.Q['MovieCompanies']
+		classes = [typeids[t] for t in classes 
+				if t in typeids and t not in links]
+		links = [typeids[t] for t in links if t in typeids]
+		if len(classes): # only presence, in one aggregated query
+			query = lambda: select([M.q.companyID, M.q.companyTypeID]) \
+						.where(self.boundIn(M.q.companyID, 'id', n)) \
+						.where(self.boundIn(M.q.companyTypeID, 'type', 
+											len(classes))) \
+						.group_by(M.q.companyID, M.q.companyTypeID)
+			for cid, ctype in self.runStatement(('company classes', n, 
+						len(classes)), query, 
+						**self.listParams('type', classes, params)):
+				res[cid][self._compType[ctype]] = [None]
+		
+		if len(links):
+			T = self.Q['Title']
+			query = lambda: select([M.q.companyID, M.q.companyTypeID, 
+						M.q.note, M.q.movieID, T.q.title, T.q.kindID, 
+						T.q.productionYear, T.q.imdbIndex, T.q.seasonNr, 
+						T.q.episodeNr, T.q.seriesYears, T.q.episodeOfID]) \
+						.where(M.q.movieID == T.q.id) \
+						.where(self.boundIn(M.q.companyID, 'id', n)) \
+						.where(self.boundIn(M.q.companyTypeID, 'type', 
+											len(links))) \
+						.order_by(M.q.id)
+			rows = self.runStatement(('company links', n, len(links)), query,
+						**self.listParams('type', links, params)).fetchall()
+			
+			series = self.seriesOf(set(r[11] for r in rows))
+			for row in rows:
+				cid, ctype, note, mid = row[:4]
+				data = self.movieData(*row[4:11])
+				if row[11] is not None:
+					data['episode of'] = series[row[11]]
+				movie = imdb.Movie.Movie(movieID=mid, data=data, 
+							notes=note or u'', accessSystem='sql')
+				res[cid].setdefault(self._compType[ctype], []).append(movie)
+			for data in res.values():
+				for ctype in links:
+					data.get(self._compType[ctype], []).sort()
+		
+		result = {}
+		for cid, data in res.items():
+			result[cid] = imdb.Company.Company(companyID=cid, data=data,
+											accessSystem='sql')
+		return result
+	
+	def getCharactersFast(self, ids, filmography=False, results=1000):
+		"""Returns a dict with a Character object for each of the given
+		character ids: the char_name rows in one query. The filmography 
+		(cast_info.person_role_id) is only loaded when asked for (links),
+		with the same limit, roles and order as get_character."""
+		ids = list(ids)
+		if not len(ids):
+			return {}
+		C = self.Q['CharName']
+		n = len(ids)
+		params = self.listParams('id', ids)
+		
+		res = {}
+		query = lambda: select([C.q.id, C.q.name, C.q.imdbIndex]) \
+						.where(self.boundIn(C.q.id, 'id', n))
+		for cid, name, index in self.runStatement(('characters', n), query,
+												**params):
+			res[cid] = {'name': name}
+			if index is not None:
+				res[cid]['imdbIndex'] = index
+		
+		if filmography:
+			I = self.Q['CastInfo']
+			T = self.Q['Title']
+			N = self.Q['Name']
+			query = lambda: select([I.q.personRoleID, I.q.roleID, I.q.note, 
+						I.q.movieID, T.q.title, T.q.kindID, T.q.productionYear,
+						T.q.imdbIndex, T.q.seasonNr, T.q.episodeNr, 
+						T.q.seriesYears, T.q.episodeOfID, I.q.personID, 
+						N.q.name]) \
+						.where(I.q.movieID == T.q.id) \
+						.where(I.q.personID == N.q.id) \
+						.where(self.boundIn(I.q.personRoleID, 'id', n)) \
+						.order_by(I.q.id)
+			rows = self.runStatement(('character films', n), query, 
+									**params).fetchall()
+			series = self.seriesOf(set(r[11] for r in rows))
+			
+			films = {}
+			for row in rows:
+				cid, role, note, mid = row[:4]
+				films.setdefault(cid, []).append(row)
+			for cid, rows in films.items():
+				fdata = []
+				for row in rows[:results]:
+					if self._role[row[1]] not in ('actor', 'actress'):
+						continue
+					data = self.movieData(*row[4:11])
+					if row[11] is not None:
+						data['episode of'] = series[row[11]]
+					fdata.append(imdb.Movie.Movie(movieID=row[3], data=data,
+								currentRole=row[13] or u'', roleID=row[12],
+								roleIsPerson=True, notes=row[2] or u'', 
+								accessSystem='sql'))
+				fdata = merge_roles(fdata)
+				fdata.sort()
+				if fdata:
+					res[cid]['filmography'] = fdata
+		
+		result = {}
+		for cid, data in res.items():
+			result[cid] = imdb.Character.Character(characterID=cid, data=data,
+												accessSystem='sql')
+		return result
+	
+	def getPersonsFast(self, ids):
+		"""Returns a dict with a Person object for each of the given person
+		ids, without the filmography: the name, the person_info and for each
+		role a [None] list (when the person has that role in get_person), 
+		so the classes and the gender still work. The episodes of 
+		get_person are left out. Not for links."""
+		ids = list(ids)
+		if not len(ids):
+			return {}
+		N = self.Q['Name']
+		n = len(ids)
+		params = self.listParams('id', ids)
+		
+		res = {}
+		query = lambda: select([N.q.id, N.q.name, N.q.imdbIndex]) \
+						.where(self.boundIn(N.q.id, 'id', n))
+		for pid, name, index in self.runStatement(('persons', n), query, 
+												**params):
+			res[pid] = {'name': name}
+			if index is not None:
+				res[pid]['imdbIndex'] = index
+		
+		# roles in one aggregated query, episodes don't count (like IMDbPY)
+		C = self.Q['CastInfo']
+		T = self.Q['Title']
+		query = lambda: select([C.q.personID, C.q.roleID]) \
+					.where(C.q.movieID==T.q.id) \
+					.where(T.q.episodeOfID == None) \
+					.where(self.boundIn(C.q.personID, 'id', n)) \
+					.group_by(C.q.personID, C.q.roleID)
+		for pid, role in self.runStatement(('person roles', n), query, 
+											**params):
+			duty = self._role[role]
+			if duty == 'guest':
+				duty = 'notable tv guest appearances'
+			res[pid][duty] = [None]
+		
+		I = self.Q['PersonInfo']
+		query = lambda: select([I.q.personID, I.q.infoTypeID, I.q.info, 
+							I.q.note]) \
+					.where(self.boundIn(I.q.personID, 'id', n)) \
+					.order_by(I.q.id)
+		for pid, infotype, info, note in self.runStatement(('person info', n),
+														query, **params):
+			if note:
+				info += '::%s' % note
+			res[pid].setdefault(self._info[infotype], []).append(info)
+		
+		result = {}
+		for pid, data in res.items():
+			for key in ('birth date', 'birth notes', 'death date', 
+						'death notes', 'birth name', 'height'):
+				if key in data:
+					data[key] = data[key][0]
+			result[pid] = imdb.Person.Person(personID=pid, data=data,
+											accessSystem='sql')
+		return result
+	
+	def getMoviesBulk(self, ids, cast=False, companies=False, keys=None):
+		"""Returns a dict with a Movie object for each of the given title ids.
+		The whole batch is fetched with a handful of IN queries instead of 
+		the dozens of queries get_movie(id, 'main') does per title.
+		The data has the same keys and values as the result of get_movie, 
+		except the akas and the complete cast/crew. The cast and company 
+		lists are only fetched when asked for (for the links).
+		keys: only these imdbpykeys (info types, keywords, connections, 
+		episode of, episodes,...) are loaded, all of them when None. The 
+		title row is always loaded."""
+		ids = list(ids)
+		if not len(ids):
+			return {}
+		T = self.Q['Title']
+		n = len(ids)
+		params = self.listParams('id', ids)
+		wanted = lambda *names: keys is None or bool(set(names) & set(keys))
+		
+		res = {}
+		query = lambda: select([T.q.id, T.q.title, T.q.kindID, 
+						T.q.productionYear, T.q.imdbIndex, T.q.seasonNr,
+						T.q.episodeNr, T.q.seriesYears, T.q.episodeOfID]) \
+						.where(self.boundIn(T.q.id, 'id', n))
+		rows = self.runStatement(('movies', n), query, **params).fetchall()
+		series = {}
+		if wanted('episode of'):
+			series = self.seriesOf(set(row[8] for row in rows))
+		for row in rows:
+			res[row[0]] = self.movieData(*row[1:8])
+			if row[8] in series:
+				res[row[0]]['episode of'] = series[row[8]]
+		
+		# info about the movie: genres, tech info, votes,...
+		infotypes = None
+		if keys is not None: # e.g. no thousands of quotes when not needed
+			infotypes = [self._infoRev[k] for k in keys if k in self._infoRev]
+			if not len(infotypes):
+				infotypes = ()
+		for table in (self.Q['MovieInfo'], self.Q['MovieInfoIdx']):
+			if infotypes == ():
+				break
+			def query():
+				query = select([table.q.movieID, table.q.infoTypeID,
+								table.q.info, table.q.note])
+				query = query.where(self.boundIn(table.q.movieID, 'id', n))
+				if infotypes is not None:
+					query = query.where(self.boundIn(table.q.infoTypeID, 
+													'type', len(infotypes)))
+				return query.order_by(table.q.id)
+			shape = ('movie info', table._imdbpyName, n, 
+					infotypes and len(infotypes))
+			for mid, infotype, info, note in self.runStatement(shape, query,
+							**self.listParams('type', infotypes or [], params)):
+				if note:
+					info += '::%s' % note
+				res[mid].setdefault(self._info[infotype], []).append(info)
+		
+		if wanted('keywords'):
+			MK = self.Q['MovieKeyword']
+			K = self.Q['Keyword']
+			query = lambda: select([MK.q.movieID, K.q.keyword]) \
+						.where(MK.q.keywordID==K.q.id) \
+						.where(self.boundIn(MK.q.movieID, 'id', n)) \
+						.order_by(MK.q.id)
+			for mid, keyword in self.runStatement(('keywords', n), query, 
+												**params):
+				res[mid].setdefault('keywords', []).append(keyword)
+		
+		if wanted('connections'): # movie connections
+			L = self.Q['MovieLink']
+			query = lambda: select([L.q.movieID, L.q.linkTypeID, 
+							L.q.linkedMovieID, T.q.title, T.q.kindID, 
+							T.q.productionYear, T.q.imdbIndex, T.q.seasonNr,
+							T.q.episodeNr, T.q.seriesYears, T.q.episodeOfID]) \
+						.where(L.q.linkedMovieID==T.q.id) \
+						.where(self.boundIn(L.q.movieID, 'id', n)) \
+						.order_by(L.q.id)
+			rows = self.runStatement(('connections', n), query, 
+									**params).fetchall()
+			linkedSeries = self.seriesOf(set(row[10] for row in rows))
+			for row in rows:
+				data = self.movieData(*row[3:10])
+				if row[10] is not None:
+					data['episode of'] = linkedSeries[row[10]]
+				movie = imdb.Movie.Movie(movieID=row[2], data=data,
+										accessSystem='sql')
+				connections = res[row[0]].setdefault('connections', {})
+				connections.setdefault(self._link[row[1]], []).append(movie)
+		
+		if wanted('episodes', 'number of episodes', 'number of seasons'):
+			query = lambda: select([T.q.episodeOfID, T.q.id, T.q.title, 
+							T.q.kindID, T.q.productionYear, T.q.imdbIndex, 
+							T.q.seasonNr, T.q.episodeNr, T.q.seriesYears]) \
+						.where(self.boundIn(T.q.episodeOfID, 'id', n)) \
+						.order_by(T.q.id)
+			for row in self.runStatement(('episodes', n), query, **params):
+				data = res[row[0]]
+				parent = imdb.Movie.Movie(movieID=row[0], accessSystem='sql',
+							data={'title': data['title'], 'kind': data['kind'],
+								'year': data.get('year'), 
+								'imdbIndex': data.get('imdbIndex')})
+				episode = imdb.Movie.Movie(movieID=row[1], accessSystem='sql',
+										data=self.movieData(*row[2:]))
+				episode['episode of'] = parent
+				season = episode.get('season', 'UNKNOWN')
+				episodes = data.setdefault('episodes', {}) \
+								.setdefault(season, {})
+				number = episode.get('episode')
+				if number is None:
+					number = max(episodes.keys() or [0]) + 1
+				episodes[number] = episode
+			for data in res.values():
+				if 'episodes' in data:
+					data['number of episodes'] = sum([len(season) for 
+										season in data['episodes'].values()])
+					data['number of seasons'] = len(data['episodes'])
+		
+		if cast: # same grouping and order as IMDbPY
+			C = self.Q['CastInfo']
+			N = self.Q['Name']
+			R = self.Q['CharName']
+			query = lambda: select([C.q.movieID, C.q.personID, C.q.nrOrder, 
+							C.q.roleID, C.q.note, N.q.name, N.q.imdbIndex,
+							R.q.id, R.q.name], 
+						from_obj=[C.table.join(N.table, C.q.personID==N.q.id)
+							.outerjoin(R.table, C.q.personRoleID==R.q.id)]) \
+						.where(self.boundIn(C.q.movieID, 'id', n)) \
+						.order_by(C.q.id)
+			duties = set()
+			for mid, pid, order, role, note, name, index, rid, character \
+						in self.runStatement(('cast', n), query, **params):
+				duty = self._role[role]
+				if duty in ('actor', 'actress'):
+					duty = 'cast'
+				duties.add(duty)
+				person = imdb.Person.Person(personID=pid, name=name,
+									currentRole=character or u'', roleID=rid,
+									notes=note or u'', accessSystem='sql')
+				if index:
+					person['imdbIndex'] = index
+				person.billingPos = order
+				res[mid].setdefault(duty, []).append(person)
+			for data in res.values():
+				for duty in duties:
+					if duty == 'cast' and duty in data:
+						data[duty] = merge_roles(data[duty])
+					data.get(duty, []).sort()
+				
+		if companies:
+			M = self.Q['MovieCompanies']
+			C = self.Q['CompanyName']
+			query = lambda: select([M.q.movieID, M.q.companyID, 
+							M.q.companyTypeID, M.q.note, C.q.name, 
+							C.q.countryCode]) \
+						.where(M.q.companyID==C.q.id) \
+						.where(self.boundIn(M.q.movieID, 'id', n)) \
+						.order_by(M.q.id)
+			for mid, cid, ctype, note, name, country in self.runStatement(
+								('movie companies', n), query, **params):
+				if country:
+					name += ' %s' % country
+				company = imdb.Company.Company(companyID=cid, name=name,
+									notes=note or u'', accessSystem='sql')
+				res[mid].setdefault(self._compType[ctype], []).append(company)
+		
+		# same transformations as IMDbPY does after fetching a movie
+		result = {}
+		for tid, data in res.items():
+			data = _reGroupDict(data, self._moviesubs)
+			if 'runtimes' in data and re_episodes.search(data['runtimes'][0]):
+				runtime = re_episodes.sub('', data['runtimes'][0])
+				if runtime[-2:] == '::':
+					runtime = runtime[:-2]
+				data['runtimes'][0] = runtime
+			if 'votes' in data:
+				data['votes'] = int(data['votes'][0])
+			if 'rating' in data:
+				data['rating'] = float(data['rating'][0])
+			if 'votes distribution' in data:
+				data['votes distribution'] = data['votes distribution'][0]
+			if 'mpaa' in data:
+				data['mpaa'] = data['mpaa'][0]
+			if 'quotes' in data:
+				data['quotes'] = [quote.split('::') for quote in data['quotes']]
+			if 'bottom 10 rank' in data: # IMDbPY drops it too
+				del data['bottom 10 rank']
+			for old, new in (('guest', 'guests'), ('trademarks', 'trade-mark'),
+						('articles', 'article'), ('pictorials', 'pictorial'),
+						('magazine-covers', 'magazine-cover-photo')):
+				if old in data:
+					data[new] = data.pop(old)
+			result[tid] = imdb.Movie.Movie(movieID=tid, data=data,
+										accessSystem='sql')
+		return result
+	
+	def getEdges(self, ids, links):
+		"""Returns the (parent_id, child_id, link_kind, nr_order) tuples of the
+		given links (cast, producer, distributors, follows,...) of a batch of
+		title ids. One query over cast_info, movie_companies and movie_link
+		each, without building Person/Company/Movie objects.
+		The edges of a title and link kind are in the order get_movie lists
+		the linked entities: the persons merged and sorted like IMDbPY does,
+		the companies and titles in the order of their rows."""
+		ids = list(ids)
+		links = set(links)
+		if not len(ids) or not len(links):
+			return []
+		n = len(ids)
+		params = self.listParams('id', ids)
+		groups = {} # (parent, link kind) -> [(sort key, child, nr_order)]
+		
+		# persons: same grouping, merging and sorting as IMDbPY (cmpPeople)
+		roles = {}
+		for rid, duty in self._role.items():
+			if duty in ('actor', 'actress'):
+				duty = 'cast'
+			if duty in links:
+				roles[rid] = duty
+		if len(roles):
+			C = self.Q['CastInfo']
+			N = self.Q['Name']
+			query = lambda: select([C.q.movieID, C.q.personID, C.q.roleID, 
+							C.q.nrOrder, N.q.name, N.q.imdbIndex]) \
+						.where(C.q.personID==N.q.id) \
+						.where(self.boundIn(C.q.roleID, 'type', len(roles))) \
+						.where(self.boundIn(C.q.movieID, 'id', n)) \
+						.order_by(C.q.id)
+			merged = set()
+			for mid, pid, role, order, name, index in self.runStatement(
+						('person edges', n, len(roles)), query,
+						**self.listParams('type', roles.keys(), params)):
+				duty = roles[role]
+				name = analyze_name(name, canonical=1)['name']
+				if duty == 'cast': # merge_roles keeps the first equal person
+					if (mid, order, name, index) in merged:
+						continue
+					merged.add((mid, order, name, index))
+				key = (order or _last, name, index or _last)
+				groups.setdefault((mid, duty), []).append((key, pid, order))
+		
+		# companies: in the order of the movie_companies table
+		types = [t for t, kind in self._compType.items() if kind in links]
+		if len(types):
+			M = self.Q['MovieCompanies']
+			query = lambda: select([M.q.movieID, M.q.companyID, 
+							M.q.companyTypeID]) \
+						.where(self.boundIn(M.q.companyTypeID, 'type', 
+											len(types))) \
+						.where(self.boundIn(M.q.movieID, 'id', n)) \
+						.order_by(M.q.id)
+			for i, (mid, cid, ctype) in enumerate(self.runStatement(
+						('company edges', n, len(types)), query,
+						**self.listParams('type', types, params))):
+				groups.setdefault((mid, self._compType[ctype]), []) \
+							.append((i, cid, None))
+		
+		# titles: in the order of the movie_link table
+		linktypes = [t for t, kind in self._link.items() if kind in links]
+		if len(linktypes):
+			L = self.Q['MovieLink']
+			query = lambda: select([L.q.movieID, L.q.linkedMovieID, 
+							L.q.linkTypeID]) \
+						.where(self.boundIn(L.q.linkTypeID, 'type', 
+											len(linktypes))) \
+						.where(self.boundIn(L.q.movieID, 'id', n)) \
+						.order_by(L.q.id)
+			for i, (mid, lid, linktype) in enumerate(self.runStatement(
+						('title edges', n, len(linktypes)), query,
+						**self.listParams('type', linktypes, params))):
+				groups.setdefault((mid, self._link[linktype]), []) \
+							.append((i, lid, None))
+		
+		edges = []
+		for (mid, kind), children in groups.items():
+			children.sort(key=lambda child: child[0])
+			edges.extend([(mid, child, kind, order) 
+						for key, child, order in children])
+		return edges
 		
 # replace IMDbPY SQL access system with our additions	
 imdb.parser.sql.IMDbSqlAccessSystem = MyIMDbSqlAccessSystem
 
+###############################################################################
+## Some tests #################################################################
+###############################################################################
+
+# test data: (id, kind id, production year, series years) of the titles
+testTitles = [(1, 1, 1990, None), (2, 1, 2005, None), (3, 1, None, None),
+			(4, 1, 1950, None), (5, 2, 1997, u'1997'), 
+			(6, 2, 1964, u'1964-1967'), (7, 1, 2010, None)]
+# (title id, imdbpykey, info, note) of their info rows
+testInfo = [(1, 'votes', u'500', None), (2, 'votes', u'50', None),
+			(4, 'votes', u'12000', None), (5, 'votes', u'5', None),
+			(1, 'rating', u'7.9', None), (2, 'rating', u'5.0', None),
+			(4, 'rating', u'8.0', None), (5, 'rating', u'6.5', None),
+			(4, 'top 250 rank', u'17', None), (7, 'top 250 rank', u'3', None),
+			(1, 'runtimes', u'USA:120', None), (1, 'runtimes', u'90', None),
+			(2, 'runtimes', u'USA:?', None), (4, 'runtimes', u'30', None),
+			(4, 'runtimes', u'200', None), 
+			(6, 'runtimes', u'USA:45', u'(12 episodes)'),
+			(1, 'genres', u'Drama', None), (1, 'genres', u'Comedy', None),
+			(2, 'genres', u'Drama', u'(segment)'), 
+			(4, 'genres', u'Western', None), (5, 'genres', u'Comedy', None),
+			(1, 'countries', u'USA', None), (2, 'countries', u'Belgium', None),
+			(1, 'color info', u'Color', None), 
+			(4, 'color info', u'Black and White', None),
+			(1, 'tech info', u'CAM:Panavision', None), 
+			(1, 'tech info', u'LAB:DeLuxe', None),
+			(2, 'tech info', u'CAM:Arri', None), 
+			(2, 'tech info', u'CAM:Panavision', None),
+			(4, 'tech info', u'OFM:35 mm', None)]
+# (title id, keyword)
+testKeywords = [(1, u'ghost'), (4, u'ghost'), (4, u'train')]
+# (id, name) of the persons, (person id, imdbpykey, info) of their info
+testPersons = [(1, u'Doe, John'), (2, u'Doe, Jane'), (3, u'Roe, Richard'),
+			(4, u'Smith, Al'), (5, u'Smith, Al')]
+testPersonInfo = [(1, 'birth name', u'John Smith'), (3, 'height', u'6\' 2"')]
+# (id, series id, season, episode) of the episodes of the series
+testEpisodes = [(8, 6, 1, 1), (9, 6, 1, 2), (10, 6, 2, None), 
+				(11, 6, None, None)]
+# (id, name) of the characters, (id, name, country) of the companies
+testCharacters = [(1, u'Hero'), (2, u'Villain')]
+testCompanies = [(1, u'Acme', u'[us]'), (2, u'Zeta Films', None), 
+				(3, u'Beta', u'[fr]')]
+# (title id, person id, character id, nr_order, role, note) of the cast
+testCast = [(1, 1, 1, 1, 'actor', None), (1, 2, 2, 3, 'actress', None),
+			(1, 1, 2, 2, 'actor', u'(voice)'), (1, 4, None, None, 'actor', None),
+			(1, 5, None, None, 'actor', None), (1, 3, None, None, 'director', 
+			None), (2, 1, 1, 2, 'actor', None), (2, 2, None, 1, 'actress', 
+			None), (8, 2, None, None, 'actress', None), 
+			(6, 3, None, None, 'producer', None)]
+# (title id, company id, company type, note) and (title id, linked title 
+# id, link type) of the titles
+testMovieCompanies = [(1, 2, 'distributors', u'(1990) (USA)'),
+			(1, 1, 'distributors', None), (1, 3, 'distributors', None),
+			(1, 1, 'production companies', None), (4, 1, 'distributors', None),
+			(8, 3, 'production companies', None)]
+testLinks = [(1, 2, 'follows'), (2, 1, 'followed by'), (1, 4, 'references')]
+
+def memoryDatabase():
+	"""IMDbPY access object of an in-memory SQLite database with the
+	schema of imdbpy2sql and the test data above (filled once)."""
+	uri = 'sqlite://'
+	engine = pooledEngine(uri) # one connection per thread: the same db
+	tables = dict((ta._imdbpyName, ta) for ta in getDBTables(uri))
+	if not tables['KindType'].table.exists(bind=engine):
+		for ta in tables.values():
+			ta.table.create(bind=engine)
+			for column, values in (ta._imdbpySchema.values or {}).items():
+				engine.execute(ta.table.insert(), 
+						[{'id': i + 1, ta.colMap[column]: value} 
+						for i, value in enumerate(values)])
+		def typeIds(name, column):
+			return dict((v, i + 1) for i, v in enumerate(
+				tables[name]._imdbpySchema.values[column]))
+		infotypes = typeIds('InfoType', 'info')
+		engine.execute(tables['Title'].table.insert(),
+			[{'id': tid, 'title': u'Title %d' % tid, 'kind_id': kind,
+			'production_year': year, 'series_years': series} 
+			for tid, kind, year, series in testTitles])
+		engine.execute(tables['Title'].table.insert(),
+			[{'id': tid, 'title': u'Title %d' % tid, 'kind_id': 
+			typeIds('KindType', 'kind')['episode'], 'episode_of_id': series,
+			'season_nr': season, 'episode_nr': episode} 
+			for tid, series, season, episode in testEpisodes])
+		for mid, key, info, note in testInfo:
+			name = 'MovieInfo'
+			if key in MyIMDbSqlAccessSystem.indexKeys:
+				name = 'MovieInfoIdx'
+			engine.execute(tables[name].table.insert(), movie_id=mid,
+						info_type_id=infotypes[key], info=info, note=note)
+		for i, (mid, keyword) in enumerate(testKeywords):
+			engine.execute(tables['Keyword'].table.insert(), id=i + 1,
+						keyword=keyword)
+			engine.execute(tables['MovieKeyword'].table.insert(), 
+						movie_id=mid, keyword_id=i + 1)
+		engine.execute(tables['Name'].table.insert(), 
+			[{'id': pid, 'name': name} for pid, name in testPersons])
+		for pid, key, info in testPersonInfo:
+			engine.execute(tables['PersonInfo'].table.insert(), 
+						person_id=pid, info_type_id=infotypes[key], info=info)
+		engine.execute(tables['CharName'].table.insert(), 
+			[{'id': cid, 'name': name} for cid, name in testCharacters])
+		engine.execute(tables['CompanyName'].table.insert(), 
+			[{'id': cid, 'name': name, 'country_code': country} 
+			for cid, name, country in testCompanies])
+		roles = typeIds('RoleType', 'role')
+		engine.execute(tables['CastInfo'].table.insert(), 
+			[{'movie_id': mid, 'person_id': pid, 'person_role_id': cid,
+			'nr_order': order, 'role_id': roles[role], 'note': note} 
+			for mid, pid, cid, order, role, note in testCast])
+		ctypes = typeIds('CompanyType', 'kind')
+		engine.execute(tables['MovieCompanies'].table.insert(), 
+			[{'movie_id': mid, 'company_id': cid, 'note': note,
+			'company_type_id': ctypes[ctype]} 
+			for mid, cid, ctype, note in testMovieCompanies])
+		links = typeIds('LinkType', 'link')
+		engine.execute(tables['MovieLink'].table.insert(), 
+			[{'movie_id': mid, 'linked_movie_id': lid, 
+			'link_type_id': links[link]} for mid, lid, link in testLinks])
+	return imdb.IMDb('sql', uri=uri, useORM='sqlalchemy')
+
+class TestConstraintFilters(unittest.TestCase):
+	"""The where clauses of the constraints (see constraintFilters) must
+	keep every entity the constraint check of the program accepts."""
+	
+	def setUp(self):
+		from dfw import AbstractEntity
+		class Entity(AbstractEntity):
+			name = "Test"
+			key_prefix = "t"
+		self.entity = Entity()
+		self.db = memoryDatabase()
+		self.db._hasRatings = False # only the info tables
+		self.kinds = [1, 2]
+		self.titles = [tid for tid, _kind, _year, _series in testTitles]
+	
+	def enable(self, attr, ctype, **settings):
+		"""Enables the constraint of the type of the attribute"""
+		for const in attr.constraints:
+			if const.type == ctype:
+				const.enabled = True
+				for name, value in settings.items():
+					setattr(const, name, value)
+		return attr
+	
+	def check(self, attr):
+		"""Returns the titles the database keeps and the titles the program
+		accepts with the enabled constraints of the attribute"""
+		constraints = [(attr, const) for const in attr.constraints 
+					if const.enabled]
+		kept = set(sum(self.db.iterTitles(self.kinds, 
+									constraints=constraints), []))
+		movies = self.db.getMoviesBulk(self.titles, keys=[attr.imdbpykey])
+		accepted = set(tid for tid, movie in movies.items() 
+					if attr.checkConstraint(movie))
+		self.assertTrue(accepted <= kept, "dropped by the database: %s" % 
+						sorted(accepted - kept))
+		return kept, accepted
+	
+	def test_ranges(self):
+		from imdbattr import Year, SeriesEndYear, Votes, Rating, Top250Rank
+		ctype = Constraint.RANGE
+		kept, accepted = self.check(self.enable(Year(self.entity), ctype, 
+												curMin=1960, curMax=2000))
+		self.assertEqual(kept, set([1, 3, 5, 6]))
+		self.assertEqual(kept, accepted)
+		# a series year that isn't a single year passes
+		kept, accepted = self.check(self.enable(SeriesEndYear(self.entity), 
+										ctype, curMin=1990, curMax=2000))
+		self.assertEqual(kept, set(self.titles))
+		self.assertEqual(kept, accepted)
+		kept, accepted = self.check(self.enable(Votes(self.entity), ctype, 
+												curMin=100, curMax=1000))
+		self.assertEqual(kept, set([1, 3, 6, 7]))
+		self.assertEqual(kept, accepted)
+		# int(rating) is compared
+		kept, accepted = self.check(self.enable(Rating(self.entity), ctype, 
+												curMin=7, curMax=7))
+		self.assertEqual(kept, set([1, 3, 6, 7]))
+		self.assertEqual(kept, accepted)
+		kept, accepted = self.check(self.enable(Top250Rank(self.entity), 
+										ctype, curMin=1, curMax=10))
+		self.assertEqual(kept, set([1, 2, 3, 5, 6, 7]))
+		self.assertEqual(kept, accepted)
+	
+	def test_runtimes(self):
+		from imdbattr import Runtime
+		runtime = self.enable(Runtime(self.entity), Constraint.RANGE, 
+							curMin=100, curMax=300)
+		kept, accepted = self.check(runtime)
+		self.assertEqual(accepted, set([1, 3, 4, 5, 7]))
+		# a runtime that isn't a number is left to the program
+		self.assertEqual(kept - accepted, set([2]))
+	
+	def test_required_ranges(self):
+		from imdbattr import Year, Votes
+		year = self.enable(Year(self.entity), Constraint.RANGE, 
+						curMin=1960, curMax=2000)
+		kept, accepted = self.check(self.enable(year, 
+												Constraint.AVAILABILITY))
+		self.assertEqual(kept, set([1, 5, 6]))
+		self.assertEqual(kept, accepted)
+		votes = self.enable(Votes(self.entity), Constraint.RANGE, 
+						curMin=1, curMax=100)
+		kept, accepted = self.check(self.enable(votes, 
+												Constraint.AVAILABILITY))
+		self.assertEqual(kept, set([2, 5]))
+		self.assertEqual(kept, accepted)
+
+	def test_values(self):
+		from imdbattr import Genres, Countries, ColorInfo
+		ctype = Constraint.VALUES
+		# a value with a note doesn't count
+		genres = self.enable(Genres(self.entity), ctype, 
+							values={u'Drama': True, u'Western': False})
+		kept, accepted = self.check(genres)
+		self.assertEqual(kept, set([1, 3, 6, 7]))
+		self.assertEqual(kept, accepted)
+		kept, accepted = self.check(self.enable(Countries(self.entity), ctype,
+							values={u'Belgium': True, u'USA': False}))
+		self.assertEqual(kept, set([2, 3, 4, 5, 6, 7]))
+		self.assertEqual(kept, accepted)
+		kept, accepted = self.check(self.enable(ColorInfo(self.entity), ctype,
+							values={u'Color': True, u'Black and White': True}))
+		self.assertEqual(kept, set(self.titles))
+		self.assertEqual(kept, accepted)
+	
+	def test_required_values(self):
+		from imdbattr import Genres
+		genres = self.enable(Genres(self.entity), Constraint.VALUES, 
+							values={u'Drama': True, u'Comedy': True})
+		kept, accepted = self.check(self.enable(genres, 
+												Constraint.AVAILABILITY))
+		self.assertEqual(kept, set([1, 5]))
+		self.assertEqual(kept, accepted)
+		# nothing checked: only titles without the attribute
+		genres = self.enable(Genres(self.entity), Constraint.VALUES, 
+							values={u'Drama': False})
+		kept, accepted = self.check(genres)
+		self.assertEqual(kept, set([3, 6, 7]))
+		self.assertEqual(kept, accepted)
+		kept, accepted = self.check(self.enable(genres, 
+												Constraint.AVAILABILITY))
+		self.assertEqual(kept, set())
+		self.assertEqual(kept, accepted)
+
+	def test_availability(self):
+		from imdbattr import Keywords, Year, SeriesEndYear, Votes
+		from imdbattr import CameraModel, Laboratory
+		ctype = Constraint.AVAILABILITY
+		for attr, titles in ((Keywords, [1, 4]), 
+							(Year, [1, 2, 4, 5, 6, 7]),
+							(SeriesEndYear, [5, 6]),
+							(Votes, [1, 2, 4, 5]),
+							(CameraModel, [1, 2]), # only the CAM rows
+							(Laboratory, [1])):
+			kept, accepted = self.check(self.enable(attr(self.entity), ctype))
+			self.assertEqual(kept, set(titles))
+			self.assertEqual(kept, accepted)
+	
+	def test_unique(self):
+		from imdbattr import Keywords, Genres, Votes, CameraModel
+		ctype = Constraint.AVAILABILITY
+		for attr, titles in ((Keywords, [1]), 
+							(Genres, [2, 4, 5]),
+							(Votes, [1, 2, 4, 5]),
+							(CameraModel, [1])):
+			kept, accepted = self.check(self.enable(attr(self.entity), ctype,
+													unique=True))
+			self.assertEqual(kept, set(titles))
+			self.assertEqual(kept, accepted)
+	
+	def test_person_availability(self):
+		from imdbattr import BirthName, Height
+		for attr, persons in ((BirthName, [1]), (Height, [3])):
+			attr = self.enable(attr(self.entity), Constraint.AVAILABILITY)
+			constraints = [(attr, const) for const in attr.constraints 
+						if const.enabled]
+			kept = set(sum(self.db.iterPersons(constraints=constraints), []))
+			data = self.db.getPersonsFast([pid for pid, _name in testPersons])
+			accepted = set(pid for pid, person in data.items() 
+						if attr.checkConstraint(person))
+			self.assertEqual(kept, set(persons))
+			self.assertEqual(kept, accepted)
+
+	def test_random(self):
+		from imdbattr import Votes, Budget
+		# only title 4 has 10000 votes or more
+		votes = self.enable(Votes(self.entity), Constraint.AVAILABILITY)
+		votes = self.enable(votes, Constraint.RANGE, curMin=10000,
+							curMax=100000)
+		budget = self.enable(Budget(self.entity), Constraint.RANGE, 
+							curMin=1000)
+		constraints = [(attr, const) for attr in (votes, budget)
+					for const in attr.constraints if const.enabled]
+		# the budget is left to the program
+		self.assertEqual(self.db.checkedConstraints(constraints),
+						constraints[:2])
+
+		limits = []
+		sample = self.db.sample
+		def recorded(query, table, limit):
+			limits.append(limit)
+			return sample(query, table, limit)
+		self.db.sample = recorded
+		chunks = list(self.db.iterTitles(self.kinds, chunk=2, random=True,
+										constraints=constraints[:2]))
+		self.assertEqual(chunks, [[4]])
+		self.assertEqual(limits, [2, 2])
+
+	def test_rating_table(self):
+		from imdbattr import Votes, Rating
+		self.assertEqual(self.db.buildRatingTable(), 5)
+		try:
+			self.db = memoryDatabase()
+			self.assertTrue(self.db.hasRatingTable())
+			for attr, low, high in ((Votes, 100, 1000), (Rating, 7, 7)):
+				attr = self.enable(attr(self.entity), Constraint.RANGE, 
+								curMin=low, curMax=high)
+				kept, accepted = self.check(attr)
+				self.assertEqual(kept, set([1, 3, 6, 7]))
+				self.assertEqual(kept, accepted)
+			
+			# built from other data (before a reload): not used
+			S = self.db._ratingSource
+			S.update().execute(fingerprint=u'0,0,0')
+			self.assertFalse(memoryDatabase().hasRatingTable())
+		finally:
+			self.db._ratingSource.drop()
+			self.db.ratingTable().drop()
+
+def plainData(value):
+	"""The data of IMDbPY objects (and the lists and dicts of them) as 
+	plain values that can be compared: the id, data, role, notes and 
+	billing position of every object."""
+	if isinstance(value, (imdb.Movie.Movie, imdb.Person.Person, 
+						imdb.Company.Company, imdb.Character.Character)):
+		role = getattr(value, 'currentRole', None)
+		if isinstance(role, list):
+			role = [(r.getID(), r.get('name')) for r in role]
+		elif role is not None:
+			role = (role.getID(), role.get('name'))
+		return (value.__class__.__name__, value.getID(), 
+				plainData(value.data), role, value.notes, 
+				getattr(value, 'billingPos', None))
+	if isinstance(value, dict):
+		return dict((k, plainData(v)) for k, v in value.items())
+	if isinstance(value, list):
+		return [plainData(v) for v in value]
+	return value
+
+class TestBulkLoaders(unittest.TestCase):
+	"""The bulk loaders give the same data as the IMDbPY getters."""
+	
+	def setUp(self):
+		self.db = memoryDatabase()
+	
+	def assertSameData(self, expected, loaded, keys=None):
+		expected = plainData(expected.data)
+		loaded = plainData(loaded.data)
+		if keys is not None:
+			expected = dict((k, v) for k, v in expected.items() if k in keys)
+			loaded = dict((k, v) for k, v in loaded.items() if k in keys)
+		self.assertEqual(sorted(expected.keys()), sorted(loaded.keys()))
+		for key, value in expected.items():
+			self.assertEqual(value, loaded[key], key)
+	
+	def test_movies(self):
+		# multi-row info, runtimes with episodes, no rating, episodes,...
+		ids = [tid for tid, _kind, _year, _series in testTitles] + \
+			[tid for tid, _series, _season, _episode in testEpisodes]
+		movies = self.db.getMoviesBulk(ids, cast=True, companies=True)
+		self.assertEqual(sorted(movies.keys()), sorted(ids))
+		for tid in ids:
+			self.assertSameData(self.db.get_movie(tid), movies[tid])
+		self.assertEqual(movies[6]['number of seasons'], 3)
+		self.assertEqual(movies[6]['runtimes'], [u'USA:45'])
+		self.assertEqual(len(movies[1]['cast']), 4)
+		
+		# only the wanted keys (and the title row)
+		keys = ['genres', 'number of seasons']
+		movies = self.db.getMoviesBulk(ids, keys=keys)
+		for tid in ids:
+			self.assertSameData(self.db.get_movie(tid), movies[tid], keys +
+				['title', 'kind', 'year', 'imdbIndex', 'season', 'episode',
+				'series years'])
+
+	def test_persons(self):
+		ids = [pid for pid, _name in testPersons]
+		persons = self.db.getPersonsFast(ids)
+		for pid in ids:
+			person = self.db.get_person(pid)
+			person.data.pop('episodes', None) # left out
+			roles = [k for k in person.keys() if k in self.db._role.values()]
+			self.assertTrue(len(roles))
+			for role in roles: # only whether the person has the role
+				self.assertEqual(persons[pid][role], [None])
+				person[role] = [None]
+			self.assertSameData(person, persons[pid])
+
+	def test_companies(self):
+		ids = [cid for cid, _name, _country in testCompanies]
+		types = self.db._compType.values()
+		companies = self.db.getCompaniesBulk(ids, links=types)
+		for cid in ids:
+			self.assertSameData(self.db.get_company(cid), companies[cid])
+		
+		# classes only: whether the company has titles of the type
+		companies = self.db.getCompaniesBulk(ids, classes=types)
+		partial = self.db.getCompaniesBulk(ids, classes=['distributors'], 
+									links=['production companies'])
+		for cid in ids:
+			company = self.db.get_company(cid)
+			for ctype in types:
+				self.assertEqual(companies[cid].get(ctype), 
+								company.get(ctype) and [None])
+			self.assertEqual(partial[cid].get('distributors'),
+							company.get('distributors') and [None])
+			self.assertEqual(plainData(partial[cid].get(
+									'production companies')),
+							plainData(company.get('production companies')))
+			self.assertFalse(partial[cid].has_key('miscellaneous companies'))
+
+	def test_characters(self):
+		ids = [cid for cid, _name in testCharacters]
+		characters = self.db.getCharactersFast(ids, filmography=True)
+		names = self.db.getCharactersFast(ids)
+		for cid in ids:
+			character = self.db.get_character(cid)
+			self.assertTrue(len(character['filmography']))
+			self.assertSameData(character, characters[cid])
+			self.assertSameData(character, names[cid], ['name', 'imdbIndex'])
+			self.assertFalse(names[cid].has_key('filmography'))
+
+	def test_edges(self):
+		# merged and sorted cast, companies in row order, linked titles
+		ids = [tid for tid, _kind, _year, _series in testTitles] + \
+			[tid for tid, _series, _season, _episode in testEpisodes]
+		links = ['cast', 'director', 'producer', 'distributors',
+				'production companies', 'follows', 'followed by', 'references']
+		children = {}
+		for mid, child, kind, _order in self.db.getEdges(ids, links):
+			children.setdefault((mid, kind), []).append(child)
+		for tid in ids:
+			movie = self.db.get_movie(tid)
+			for kind in links:
+				entities = movie.get(kind, movie.get('connections', {}).get(kind))
+				expected = [entity.getID() for entity in entities or []]
+				self.assertEqual(expected, children.get((tid, kind), []),
+								(tid, kind))
+		self.assertEqual(len(children[1, 'cast']), 4)
+		self.assertEqual(children[1, 'distributors'], [2, 1, 3])
+
+class TestPool(unittest.TestCase):
+	"""The access objects share the pool of connections."""
+	
+	def test_checked_out(self):
+		db = memoryDatabase()
+		engine = engines['sqlite://']
+		checkouts = [] # 1 for every checkout, -1 for every checkin
+		event.listen(engine, 'checkout', lambda *args: checkouts.append(1))
+		event.listen(engine, 'checkin', lambda *args: checkouts.append(-1))
+		other = imdb.IMDb('sql', uri='sqlite://', useORM='sqlalchemy')
+		self.assertEqual(sum(checkouts), 0) # none kept while idle
+		other.getMoviesBulk([1, 2], cast=True)
+		self.assertEqual(sum(checkouts), 0)
+		self.assertEqual(max(checkouts), 1)
+		self.assertEqual(other.get_movie(1)['title'], db.get_movie(1)['title'])
+
+class TestIndexAdvisor(unittest.TestCase):
+	"""The advisor explains the statements the generator runs."""
+	
+	def test_queries(self):
+		db = memoryDatabase()
+		queries = db.advisedQueries()
+		descriptions = set(d for d, _query, _params in queries)
+		for loaded in ('movies', 'cast', 'person edges', 'title edges', 
+					'persons', 'person info'):
+			self.assertTrue(loaded in descriptions, loaded)
+		plans = dict((d, db.explain(query, params)) 
+					for d, query, params in queries)
+		self.assertTrue(all(len(plan) for plan in plans.values()))
+		
+		if ('CastInfo', ('movie_id',)) in db.missingIndexes():
+			db.createIndex('CastInfo', ('movie_id',))
+		self.assertFalse(('CastInfo', ('movie_id',)) in db.missingIndexes())
+		plan = u' '.join(sum([db.explain(query, params) 
+					for d, query, params in queries if d == 'cast'], []))
+		self.assertTrue(u'gen_cast_info_movie_id' in plan, plan)
+
+class TestExtract(unittest.TestCase):
+	"""The SQLite extract has the copied rows, or no file at all."""
+	
+	def setUp(self):
+		import tempfile
+		self.db = memoryDatabase()
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, 'extract.db')
+	
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.directory)
+	
+	def test_extract(self):
+		result = self.db.extract(self.filename, minVotes=100)
+		self.assertFalse(os.path.exists(self.filename + '.part'))
+		engine = create_engine('sqlite:///%s' % self.filename)
+		try:
+			for table, amount in result.items():
+				self.assertEqual(engine.execute('SELECT COUNT(*) FROM %s' 
+											% table).scalar(), amount)
+			titles = engine.execute('SELECT id FROM title ORDER BY id')
+			self.assertEqual([r[0] for r in titles], [1, 2, 4, 6, 8])
+		finally:
+			engine.dispose()
+		self.assertEqual(result['title'], 5)
+		self.assertEqual(result['movie_keyword'], 3)
+		self.assertEqual(result['kind_type'], 7)
+		self.assertRaises(IOError, self.db.extract, self.filename)
+	
+	def test_failure(self):
+		def fail(*args, **kwargs):
+			raise RuntimeError("copy failed")
+		self.db.copyRows = fail
+		self.assertRaises(RuntimeError, self.db.extract, self.filename)
+		self.assertFalse(os.path.exists(self.filename))
+		self.assertFalse(os.path.exists(self.filename + '.part'))
+
+# when this file is not imported, but ran directly: run test code
+if __name__ == '__main__':
+	suites = list()
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(
+													TestConstraintFilters))
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(
+													TestBulkLoaders))
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(
+													TestIndexAdvisor))
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestPool))
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestExtract))
+	alltests = unittest.TestSuite(suites)
+	
+	unittest.TextTestRunner(verbosity=2).run(alltests)
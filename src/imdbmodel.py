@@ -18,17 +18,43 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 ## Database configuration options
-SQLDB = "postgresql" # mysql postgresql
+SQLDB = "postgresql" # mysql postgresql sqlite
 LOGIN = "imdb"
 PASSWORD = "imdbpwd"
 HOST = "localhost"
 PORT = "5432" # 3306 5432
-DBNAME = "imdb"
+DBNAME = "imdb" # the file with sqlite (see dbtools.py extract)
+## Connection pool options (shared by the IMDbPY instances of all workers)
+POOL_SIZE = 5 # connections kept open
+POOL_OVERFLOW = 10 # extra connections when all of them are in use
+POOL_TIMEOUT = 30 # seconds to wait for a free connection
+POOL_RECYCLE = 3600 # seconds before a connection is reopened
+POOL_PING = True # test a connection before it is used
+## Directory of the NumPy snapshot of the titles (see imdbsnapshot.py)
+SNAPSHOT_DIR = "snapshot"
+## Worker processes for the root entities (1: no worker processes)
+PROCESSES = 1
+## Chunks of entities that are fetched ahead by threads (0: no threads)
+PREFETCH = 2
+CHUNK_SIZE = 50 # entities per chunk
+## Prolog output: flushed per WRITE_BUFFER characters or WRITE_INTERVAL 
+## seconds, by a writer thread with WRITE_THREAD
+WRITE_BUFFER = 1 << 20
+WRITE_INTERVAL = 5
+WRITE_THREAD = True
 
 
 from dfw import AbstractEntity, AbstractEntityType, AbstractLink
 from imdbattr import *
+from prologwriter import PrologWriter
+from idledger import IdLedger
+import imdbsnapshot
 import traceback
+import threading
+import multiprocessing
+import multiprocessing.pool
+import math
+import os
 
 # http://www.blog.pythonlibrary.org/2012/08/02/python-101-an-intro-to-logging/
 # CRITICAL ERROR WARNING INFO DEBUG
@@ -73,20 +99,32 @@ def getConnectionString():
 	Where the 'URI' argument is a string representing the connection
 	to your database, with the schema:
 	  scheme://[user[:password]@]host[:port]/database[?parameters]
+	SQLite only needs the file: sqlite:///file
 	"""
+	if SQLDB == "sqlite":
+		return "sqlite:///%s" % DBNAME
 	return "%s://%s:%s@%s:%s/%s" % (SQLDB, LOGIN, PASSWORD, HOST, PORT, DBNAME)
 
-imdbInstance = None
+imdbInstances = threading.local() # IMDbPY instance of each thread
+imdbLock = threading.Lock()
 
 def getImdbpyInstance():
-	"""Database stuff in external file for faster startup times."""
-	global imdbInstance
-	if not imdbInstance:
+	"""Database stuff in external file for faster startup times.
+	Every thread (and process) gets its own IMDbPY instance, they take 
+	their connections from the same pool."""
+	if getattr(imdbInstances, 'pid', None) != os.getpid():
 		import imdbdb
-		imdbInstance = imdbdb.imdb.IMDb(accessSystem='sql',
-			  uri=getConnectionString(), 
-			  useORM='sqlalchemy')
-	return imdbInstance
+		with imdbLock: # IMDbPY sets module globals while connecting
+			if hasattr(imdbInstances, 'pid'): # forked: keep the parent one
+				imdbdb.forgetEngines(imdbInstances.instance)
+			imdbInstances.instance = imdbdb.imdb.IMDb(accessSystem='sql',
+				  uri=getConnectionString(), 
+				  useORM='sqlalchemy',
+				  pool={'size': POOL_SIZE, 'overflow': POOL_OVERFLOW,
+						'timeout': POOL_TIMEOUT, 'recycle': POOL_RECYCLE,
+						'ping': POOL_PING})
+			imdbInstances.pid = os.getpid()
+	return imdbInstances.instance
 
 ###############################################################################
 ## IMDb dataset construction ##################################################
@@ -95,19 +133,93 @@ def getImdbpyInstance():
 ## Entity Mix-ins #############################################################
 
 class ImdbEntity(AbstractEntity):
+	# most ids that are grabbed from the database in one go (see idChunkSize)
+	max_id_chunk_size = 50000
+	
 	def __init__(self):
 		super(ImdbEntity, self).__init__()
 		
-		self.good_ids = []
-		self.bad_ids = [] # to speed up when doing random
+		self.good_ids = IdLedger()
+		self.bad_ids = IdLedger() # to speed up when doing random
 		self.toproc_ids = []
 		self.link_ids = {} # list with linked Prolog lines
+		self.prefetched = {} # data grabbed in bulk, waiting to be processed
+		self.pending = {} # key -> (keys, result) of a fetch in a thread
+		self.idstream = None # generator with the ids from the database
+		self.idbuffer = [] # ids from the stream, not handed out yet
 		
-	def process(self, title_key, link_models, output_file):
+	def process(self, title_key, link_models, writer):
+		raise NotImplementedError("Implement this function with the entity.")
+	
+	def streamIds(self, chunk, cursor=0, random=False):
+		"""Returns a generator that yields lists of chunk ids after the 
+		cursor id."""
 		raise NotImplementedError("Implement this function with the entity.")
+	
+	def checkedConstraints(self):
+		"""The (attribute, constraint) pairs the id stream already checks:
+		its ids pass them."""
+		return []
+	
+	def idChunkSize(self, amount, random=False):
+		"""The size of the chunks of the id stream: the amount, more when 
+		the constraints the id stream doesn't check let few entities through
+		(see imdbstats.batchSize), at most max_id_chunk_size. Only uses the
+		count catalog and statistics that are already made.
+		Random ids come in chunks of the amount: the sampler keeps looking
+		until it has found a whole chunk."""
+		if random:
+			return amount
+		import imdbstats
+		size = imdbstats.batchSize(self, amount, build=False,
+								checked=self.checkedConstraints())
+		if size is None:
+			return amount
+		return max(min(size, self.max_id_chunk_size), amount)
+	
+	def grabIds(self, amount, cursor=0, random=False):
+		"""Grabs the given amount of ids after the cursor id from the id 
+		stream (chunks of idChunkSize). The ids will be used to grab the 
+		attributes of this entity later.
+		Returns the cursor for the next call."""
+		if self.idstream is None:
+			self.idstream = self.streamIds(self.idChunkSize(amount, random),
+										cursor, random)
+			self.idbuffer = []
+		while len(self.idbuffer) < amount:
+			try:
+				self.idbuffer.extend(next(self.idstream))
+			except StopIteration:
+				break
+		ids = self.idbuffer[:amount]
+		del self.idbuffer[:amount]
+		return self.addIds(ids, cursor)
+	
+	def closeIds(self):
+		"""Stops the id stream (and closes its database cursor)."""
+		if self.idstream is not None:
+			self.idstream.close()
+			self.idstream = None
+		self.idbuffer = []
+	
+	def addIds(self, ids, cursor=0):
+		"""Adds the new ids to the ids to process. Returns the keyset cursor
+		(the last id) to grab the ids after these ones."""
+		for eid in ids:
+			# skip ids that were already processed before (when doing random)
+			if not eid in self.good_ids and not eid in self.bad_ids:
+				self.toproc_ids.append(eid)
+		if len(ids):
+			return ids[-1]
+		return cursor
+	
+	def fetch(self, keys, link_models):
+		"""Grabs the data of multiple keys at once. Returns a dict with the
+		data for each key. Keys without data are grabbed by process()."""
+		return {}
 		
-	def doAll(self, key, data, link_models, output_file):
-		"""Check constraints and generate Prolog."""
+	def doAll(self, key, data, link_models, writer):
+		"""Check constraints and generate Prolog (to the PrologWriter)."""
 		# CLASS
 		try:
 			good = self.checkClassConstraint(key, data)
@@ -129,38 +241,36 @@ class ImdbEntity(AbstractEntity):
 		if good:
 			# write Prolog
 			lines = self.generatePrologEntity(key, data)
-			with open(output_file, "at") as out:
-				out.write(lines.encode("ascii", "replace"))
-				out.write("\n")
-				logging.debug(lines)
+			writer.write(lines)
+			writer.write("\n")
+			logging.debug(lines)
 			
-				# do links (not their content)
-				for linkmodel in link_models: # links to other entities
-					# grab checked links from model GUI (kind of link)
-					checked_links = [l for l, status in 
-									linkmodel.guiChecked.items() if status]
-										
-					for checked_link in checked_links: # string links
-						try:
-							# e.g. Persons
-							for i, entity in enumerate(linkmodel
-									.getLinkedEntities(data, checked_link)):
-								eid = entity.getID()
-								# so the next entity knows what to generate
-								linkmodel.getTwo().toproc_ids.append(eid)
-								
-								line = linkmodel.constructLink(
-										checked_link, key, eid, i+1)
-								
-								lst = linkmodel.getTwo().link_ids.get(eid, [])
-								lst.append(line)
-								linkmodel.getTwo().link_ids[eid] = lst
-								
-#								# write link Prolog
-#								out.write(line)
-#								print(line) # XXX: Prolog
-						except KeyError:
-							pass # Entity doesn't have a certain checked_link
+			# do links (not their content)
+			for linkmodel in link_models: # links to other entities
+				# grab checked links from model GUI (kind of link)
+				checked_links = [l for l, status in 
+								linkmodel.guiChecked.items() if status]
+									
+				for checked_link in checked_links: # string links
+					try:
+						# e.g. Persons
+						for i, eid in enumerate(linkmodel
+								.getLinkedIDs(data, checked_link)):
+							# so the next entity knows what to generate
+							linkmodel.getTwo().toproc_ids.append(eid)
+							
+							line = linkmodel.constructLink(
+									checked_link, key, eid, i+1)
+							
+							lst = linkmodel.getTwo().link_ids.get(eid, [])
+							lst.append(line)
+							linkmodel.getTwo().link_ids[eid] = lst
+							
+#							# write link Prolog
+#							out.write(line)
+#							print(line) # XXX: Prolog
+					except KeyError:
+						pass # Entity doesn't have a certain checked_link
 			
 			# so we will know what to skip directly when doing random
 			self.good_ids.append(key)
@@ -207,6 +317,14 @@ class ImdbEntity(AbstractEntity):
 		logging.error("default function called! checkClassConstraint()")
 		return True
 
+def hasCheckedLinks(link_models, entity):
+	"""Whether one of the link models has a checked link to the entity."""
+	for linkmodel in link_models:
+		if (linkmodel.getTwo().rootLevelEntityType == entity and
+				True in linkmodel.guiChecked.values()):
+			return True
+	return False
+
 class ClassConstraintLinkMixin(object):
 #	def checkClassConstraint2(self, key, data):
 #		"""All the links must exist."""
@@ -257,7 +375,6 @@ class Title(ImdbEntity):
 	def __init__(self):
 		super(Title, self).__init__()
 		self.defaultChecked = ['Movie', 'TV Movie']
-		self.votes = Votes(self, True) # for faster querying
 		self.attributes = [
 				TitleKind(self),
 				TitleName(self),
@@ -270,7 +387,7 @@ class Title(ImdbEntity):
 				Keywords(self, True),
 				
 				VotesDistribution(self, True),
-				self.votes,
+				Votes(self, True),
 				Rating(self, True),
 				Top250Rank(self, True),
 				Bottom10Rank(self),
@@ -325,42 +442,77 @@ class Title(ImdbEntity):
 						break
 		return numberList
 						
-	def grabIds(self, amount, offset=0, random=False):
-		"""Grabs the given amount of ids. The ids will be used to grab
-		the attributes of this entity later."""
+	def streamIds(self, chunk, cursor=0, random=False):
 		# we can already filter on movie, serie,...
 		categories = self._getListTypesClasses()
 		logging.debug("Title categories checked: %s" % categories)
 		if not len(categories):
 			raise AttributeError("No classes selected.") # TODO: show in GUI
 		
-		ok = True
-		for const in self.votes.constraints:
-			if const.type == Constraint.RANGE:
-				ok = const.enabled and ok
-				minval = const.curMin 
-			if const.type == Constraint.AVAILABILITY:
-				ok = const.enabled and ok
-		
-		if ok:
-			votes = minval
-			logging.info("Using FAST vote amount query.")
-		else:
-			votes = None
+		# the database already drops most titles that fail the constraints
+		constraints = [(attr, const) for attr in self.attributes
+					for const in attr.constraints if const.enabled]
 		
-		for tid in getImdbpyInstance().getTitles(categories=categories,
-				offset=offset, limit=amount, random=random, votes=votes):
-			# skip ids that were already processed before (when doing random)
-			if not tid in self.good_ids and not tid in self.bad_ids:
-				self.toproc_ids.append(tid)
+		# only range constraints: checked at once on the snapshot
+		stream = imdbsnapshot.streamIds(getImdbpyInstance(), SNAPSHOT_DIR,
+				categories, constraints, after=cursor, chunk=chunk, 
+				random=random)
+		if stream is not None:
+			return stream
+		
+		return getImdbpyInstance().iterTitles(categories=categories,
+				after=cursor, chunk=chunk, random=random, 
+				constraints=constraints)
+	
+	def checkedConstraints(self):
+		# the snapshot checks them all, or the database some of them
+		constraints = [(attr, const) for attr in self.attributes
+					for const in attr.constraints if const.enabled]
+		snapshot = imdbsnapshot.getSnapshot(getImdbpyInstance(), 
+										SNAPSHOT_DIR)
+		if snapshot is not None and snapshot.mask(
+					self._getListTypesClasses(), constraints) is not None:
+			return constraints
+		return getImdbpyInstance().checkedConstraints(constraints)
 				
-	def process(self, title_key, link_models, output_file):
+	def neededKeys(self):
+		"""The imdbpykeys of the checked attributes and of the attributes
+		with enabled constraints. The links don't need any: their ids come
+		from getEdges."""
+		keys = set()
+		for attr in self.attributes:
+			if attr.guiChecked or True in [c.enabled for c in attr.constraints]:
+				keys.add(attr.imdbpykey)
+		return keys
+	
+	def fetch(self, keys, link_models):
+		# only the info types of the needed attributes are loaded
+		imdbpy = getImdbpyInstance()
+		result = imdbpy.getMoviesBulk(keys, keys=self.neededKeys())
+		
+		# the links only need the ids of the linked entities
+		checked_links = set()
+		for linkmodel in link_models:
+			checked_links.update([l for l, status in 
+								linkmodel.guiChecked.items() if status])
+		for data in result.values():
+			data['edges'] = {}
+		for parent, child, kind, order in imdbpy.getEdges(result.keys(), 
+														checked_links):
+			result[parent]['edges'].setdefault(kind, []).append(child)
+		return result
+				
+	def process(self, title_key, link_models, writer):
 		"""title_key: PK of title record IMDbPY"""
 		# grab movie info
-		title_data = getImdbpyInstance().get_movie(title_key, 'main')
+		title_data = self.prefetched.pop(title_key, None)
+		if title_data is None:
+			title_data = self.fetch([title_key], link_models).get(title_key)
+		if title_data is None: # IMDbPY raises the error
+			title_data = getImdbpyInstance().get_movie(title_key, 'main')
 		
 		return super(Title, self).doAll(title_key, title_data, 
-									link_models, output_file)
+									link_models, writer)
 	
 	def checkClassConstraint(self, key, data):
 		success = False
@@ -471,20 +623,32 @@ class Person(ClassConstraintLinkMixin, ImdbEntity):
 						Height(self),
 		]
 		
-	def grabIds(self, amount, offset=0, random=False):
-		"""Grabs the given amount of ids. The ids will be used to grab
-		the attributes of this entity later."""
-		for pid in getImdbpyInstance().getPersons(offset=offset, limit=amount,
-		                                          random=random):
-			# skip ids that were already processed before (when doing random)
-			if not pid in self.good_ids and not pid in self.bad_ids:
-				self.toproc_ids.append(pid) 
+	def streamIds(self, chunk, cursor=0, random=False):
+		# the database already drops persons without the required attributes
+		constraints = [(attr, const) for attr in self.attributes
+					for const in attr.constraints if const.enabled]
+		return getImdbpyInstance().iterPersons(after=cursor, chunk=chunk,
+								random=random, constraints=constraints)
+	
+	def checkedConstraints(self):
+		constraints = [(attr, const) for attr in self.attributes
+					for const in attr.constraints if const.enabled]
+		return getImdbpyInstance().checkedConstraints(constraints, 'Name')
 				
-	def process(self, person_key, link_models, output_file):
-		person_data = getImdbpyInstance().get_person(person_key)
+	def fetch(self, keys, link_models):
+		# the filmography is only needed for the links
+		for linkmodel in link_models:
+			if True in linkmodel.guiChecked.values():
+				return {}
+		return getImdbpyInstance().getPersonsFast(keys)
+				
+	def process(self, person_key, link_models, writer):
+		person_data = self.prefetched.pop(person_key, None)
+		if person_data is None:
+			person_data = getImdbpyInstance().get_person(person_key)
 		
 		return super(Person, self).doAll(person_key, person_data, 
-										link_models, output_file)
+										link_models, writer)
 	
 class Actor(Person, AbstractEntityType):
 	name = "Actor"
@@ -551,24 +715,34 @@ class Company(ClassConstraintLinkMixin, ImdbEntity):
 				]
 	
 		
-	def grabIds(self, amount, offset=0, random=False):
-		"""Grabs the given amount of ids. The ids will be used to grab
-		the attributes of this entity later."""
-		for pid in getImdbpyInstance().getCompanies(offset=offset, 
-											limit=amount, random=random):
-			# skip ids that were already processed before (when doing random)
-			if not pid in self.good_ids and not pid in self.bad_ids:
-				self.toproc_ids.append(pid) 
+	def streamIds(self, chunk, cursor=0, random=False):
+		return getImdbpyInstance().iterCompanies(after=cursor, chunk=chunk,
+												random=random)
 				
-	def process(self, company_key, link_models, output_file):
+	def fetch(self, keys, link_models):
 		if not len(link_models) and self.allCompaniesSelected():
+			return {} # even faster: see process
+		# only the titles of the checked classes and links
+		classes = [ecm.imdbpyType for ecm in self.guiClassObjects 
+				if ecm.guiChecked]
+		links = []
+		for linkmodel in link_models:
+			links += [l for l, status in linkmodel.guiChecked.items() 
+					if status]
+		return getImdbpyInstance().getCompaniesBulk(keys, classes, links)
+				
+	def process(self, company_key, link_models, writer):
+		company_data = self.prefetched.pop(company_key, None)
+		if company_data is not None:
+			pass
+		elif not len(link_models) and self.allCompaniesSelected():
 			# speed up by not processing company links
 			company_data = getImdbpyInstance().getCompany(company_key)
 		else:
 			company_data = getImdbpyInstance().get_company(company_key)
 		
 		return super(Company, self).doAll(company_key, company_data, 
-										link_models, output_file)
+										link_models, writer)
 		
 	def allCompaniesSelected(self):
 		result = True
@@ -609,22 +783,22 @@ class Character(ImdbEntity):
 				CharacterName(self, True),
 				]
 		
-	def process(self, character_key, link_models, output_file):
-		character_data = getImdbpyInstance().get_character(character_key)
+	def fetch(self, keys, link_models):
+		# the filmography is only needed for the links
+		return getImdbpyInstance().getCharactersFast(keys, 
+				filmography=hasCheckedLinks(link_models, Title))
+		
+	def process(self, character_key, link_models, writer):
+		character_data = self.prefetched.pop(character_key, None)
+		if character_data is None:
+			character_data = getImdbpyInstance().get_character(character_key)
 		
 		return super(Character, self).doAll(character_key, character_data, 
-										link_models, output_file)
+										link_models, writer)
 		
-	def grabIds(self, amount, offset=0, random=False):
-		"""Grabs the given amount of ids. The ids will be used to grab
-		the attributes of this entity later."""
-
-		for cid in getImdbpyInstance().getCharacters(offset=offset,
-													 limit=amount,
-													 random=random):
-			# skip ids that were already processed before (when doing random)
-			if not cid in self.good_ids and cid not in self.bad_ids:
-				self.toproc_ids.append(cid)
+	def streamIds(self, chunk, cursor=0, random=False):
+		return getImdbpyInstance().iterCharacters(after=cursor, chunk=chunk,
+												random=random)
 				
 	def checkClassConstraint(self, key, data):
 		# we are always a character
@@ -644,6 +818,14 @@ class ImdbLink(AbstractLink):
 	def getLinkedEntities(self, pvalue, checked_link):
 		"""TitleLinkTitle has an additional layer."""
 		return pvalue[checked_link]
+
+	def getLinkedIDs(self, pvalue, checked_link):
+		"""The ids of the linked entities, straight from the bulk fetched
+		edges when there are any."""
+		if pvalue.has_key('edges'):
+			return pvalue['edges'].get(checked_link, [])
+		return [entity.getID() for entity in 
+				self.getLinkedEntities(pvalue, checked_link)]
 	
 class TitleLinkTitle(ImdbLink):
 	""" link_type table """
@@ -786,16 +968,59 @@ def getLinkModels(scene):
 			pass
 	return links
 		
+# the root model and its link models in a worker process of the generation
+workerModels = None
+
+def initWorker(model, link_models):
+	global workerModels
+	workerModels = (model, link_models)
+
+def linkedModels(link_models):
+	"""The linked entities of the link models (once each)"""
+	result = []
+	for linkmodel in link_models:
+		if linkmodel.getTwo() not in result:
+			result.append(linkmodel.getTwo())
+	return result
+
+def processRootKeys(task):
+	"""Processes root keys in a worker process, the Prolog goes to the part 
+	file. Returns the good and bad keys and the (toproc_ids, link_ids) of
+	the linked entities. See GeneratorThread.processRoots."""
+	keys, part_file = task
+	model, link_models = workerModels
+	model.good_ids = IdLedger()
+	model.bad_ids = IdLedger()
+	linked = linkedModels(link_models)
+	for entity in linked:
+		entity.toproc_ids = []
+		entity.link_ids = {}
+	model.prefetched = model.fetch(keys, link_models)
+	with PrologWriter(part_file, buffer_size=WRITE_BUFFER) as writer:
+		for key in keys:
+			model.process(key, link_models, writer)
+	model.prefetched = {}
+	return (model.good_ids, model.bad_ids, 
+			[(entity.toproc_ids, entity.link_ids) for entity in linked])
+
 class GeneratorThread(QtCore.QThread):
 	"""Thread that will generate the Prolog code.
 	Inherits from QThread so it can emit signals for the process bar."""
 	
 	# progress/total amount are the signal parameters
 	progress = QtCore.pyqtSignal(int, int)
+	
+	# amount of entities of which the data is grabbed in one go
+	chunk_size = CHUNK_SIZE
+	# more than 1: the root entities are done by a pool of processes
+	processes = PROCESSES
+	# chunks that are fetched by threads while the current entity is done
+	prefetch_depth = PREFETCH
 
 	def __init__(self, parent=None):
 		super(GeneratorThread, self).__init__(parent)
 		self.exiting = False
+		self.fetchers = None # thread pool of the prefetch stage
 		
 	def run(self):
 		# Note: This is never called directly. It is called by Qt once the
@@ -804,9 +1029,12 @@ class GeneratorThread(QtCore.QThread):
 		# debugging with pydev fails because QThread is C
 		# import pydevd;pydevd.settrace()	
 		
-		rm = getRootModel(self.scene)
-		links = getLinkModels(self.scene)
-		
+		self.generateModels(getRootModel(self.scene), 
+							getLinkModels(self.scene))
+	
+	def generateModels(self, rm, links):
+		"""Generates the Prolog of the root model and the entities linked 
+		by the link models (the diagram of the scene) to output_file."""
 		def giveLinkModels(parent_model):
 			"""AbstractLink objects for a given entity."""
 			result_list = []
@@ -856,23 +1084,61 @@ class GeneratorThread(QtCore.QThread):
 		with open(self.output_file + ".diagram.txt", "w") as dia:
 			dia.write(writeDiagram(rm))
 		
-		# make Prolog file empty
-		with open(self.output_file, "w") as pf:
-			pf.write("")
-
+		def clearCache(model):
+			model.good_ids = IdLedger()
+			model.bad_ids = IdLedger()
+			model.toproc_ids = [] # should be empty here anyway
+			model.link_ids = {}
+			model.prefetched = {}
+			model.pending = {}
+			model.closeIds()
+			
+			for linkmodel in giveLinkModels(model):
+				clearCache(linkmodel.getTwo())
 		
+		pool = None
+		writer = None
+		ahead = self.chunk_size * (self.prefetch_depth + 1)
+		try:
+			if self.processes > 1: # forked: the models are copied as they are
+				pool = multiprocessing.Pool(self.processes, initWorker, 
+											(rm, giveLinkModels(rm)))
+			if self.prefetch_depth > 0: # after the fork: no threads in workers
+				self.fetchers = multiprocessing.pool.ThreadPool(
+														self.prefetch_depth)
+			
+			# empty Prolog file, written in blocks
+			writer = PrologWriter(self.output_file, buffer_size=WRITE_BUFFER, 
+								flush_interval=WRITE_INTERVAL, 
+								threaded=WRITE_THREAD)
+			self.generateEntities(rm, giveLinkModels, pool, ahead, writer)
+		finally: # also when generating fails: no pools or cursors left
+			if self.fetchers is not None: # fetches in progress are dropped
+				self.fetchers.terminate()
+				self.fetchers.join()
+				self.fetchers = None
+			if pool is not None:
+				pool.terminate()
+				pool.join()
+			# the id streams hold database cursors: closed in any case
+			print("Clearing key cache from models.")
+			clearCache(rm)
+			getImdbpyInstance().resetSamplers()
+			if writer is not None:
+				writer.close()
+
+	def generateEntities(self, rm, giveLinkModels, pool, ahead, writer):
+		"""Generates the root entities and then the linked ones."""
 		logging.info("Grabbing IDs root entity.")
-		offset = 0
+		cursor = 0 # keyset pagination: last grabbed id
 		more_sentinel = True
 		amount = self.amount
 		while amount > 0 and more_sentinel: 
 			"""Grabs the right amount of IDs that don't fail 
 			the constraints by recursion."""
 			# only grab ids: data later
-			rm.grabIds(amount, offset, self.random)
+			cursor = rm.grabIds(amount, cursor, self.random)
 			logging.debug(str(rm.toproc_ids))
-			if not self.random:
-				offset += amount
 			
 			# prevent infinite run (no new ids found)
 			if len(rm.toproc_ids) == 0:
@@ -880,13 +1146,18 @@ class GeneratorThread(QtCore.QThread):
 				# let linked entities finish too
 				more_sentinel = False
 			
+			if pool is not None:
+				self.processRoots(pool, rm, giveLinkModels(rm), writer)
+			
 			while len(rm.toproc_ids) and not self.exiting:
 				key = rm.toproc_ids.pop()
+				self.prefetch(rm, [key] + rm.toproc_ids[:-ahead:-1],
+							giveLinkModels(rm))
 				logging.info("%d/%d - %d" % (len(rm.good_ids) + 1, 
 											self.amount, key))
 				
 				# adds key to good or bad list, write prolog, grab link ids
-				result = rm.process(key, giveLinkModels(rm), self.output_file)
+				result = rm.process(key, giveLinkModels(rm), writer)
 			
 				if result: # advance process bar
 					self.progress.emit(len(rm.good_ids), self.amount)
@@ -895,6 +1166,10 @@ class GeneratorThread(QtCore.QThread):
 			if self.exiting:
 				more_sentinel = False
 		
+		if pool is not None:
+			pool.close()
+			pool.join()
+		
 		def doLinkedEntities(parent_model):
 			"""Grabs data for the linked entities."""
 			for linkmodel in giveLinkModels(parent_model):
@@ -917,26 +1192,90 @@ class GeneratorThread(QtCore.QThread):
 					if self.exiting:
 						break
 					logging.info("%d/%d - %d" % (i+1, total, entity_id))
+					self.prefetch(linked, linked.toproc_ids[i:i+ahead],
+								giveLinkModels(linked))
 					
 #					# don't add if Title already in other Title list!!
 #					if (entity_id not in parent.good_ids and 
 #						parent.rootLevelEntityType == linked.rootLevelEntityType or
 #						parent.rootLevelEntityType != linked.rootLevelEntityType):
-					linked.process(entity_id, giveLinkModels(linked), 
-								self.output_file)
+					linked.process(entity_id, giveLinkModels(linked), writer)
 				doLinkedEntities(linked)
 		doLinkedEntities(rm)
+
+	def processRoots(self, pool, model, link_models, writer):
+		"""Processes the keys in toproc_ids with the pool of processes. Every
+		task writes its own part file. The parts, the good/bad keys and the 
+		ids for the linked entities are merged in the order of the loop 
+		without pool, so the output is the same."""
+		keys = model.toproc_ids[::-1] # the loop pops them from the end
+		del model.toproc_ids[:]
+		size = int(math.ceil(len(keys) / float(self.processes)))
+		size = max(1, min(self.chunk_size, size))
+		tasks = [(keys[i:i + size], "%s.part%d" % (self.output_file, i))
+				for i in range(0, len(keys), size)]
+		linked = linkedModels(link_models)
 		
-		print("Clearing key cache from models.")
-		def clearCache(model):
-			model.good_ids = []
-			model.bad_ids = []
-			model.toproc_ids = [] # should be empty here anyway
-			model.link_ids = {}
-			
-			for linkmodel in giveLinkModels(model):
-				clearCache(linkmodel.getTwo())
-		clearCache(rm)
+		results = pool.imap(processRootKeys, tasks) # in the order of tasks
+		for (_keys, part_file), (good, bad, ids) in zip(tasks, results):
+			if os.path.exists(part_file):
+				with open(part_file, "rb") as part:
+					writer.write(part.read())
+				os.remove(part_file)
+			model.good_ids.update(good)
+			model.bad_ids.update(bad)
+			for entity, (toproc_ids, link_ids) in zip(linked, ids):
+				entity.toproc_ids.extend(toproc_ids)
+				for eid, lines in link_ids.items():
+					entity.link_ids.setdefault(eid, []).extend(lines)
+			logging.info("%d/%d" % (len(model.good_ids), self.amount))
+			self.progress.emit(len(model.good_ids), self.amount)
+			if self.exiting:
+				pool.terminate()
+				break
+		for _keys, part_file in tasks: # left by a halt
+			if os.path.exists(part_file):
+				os.remove(part_file)
+	
+	def prefetch(self, model, keys, link_models):
+		"""Grabs the data of the first key together with the upcoming keys,
+		so the database isn't queried for every entity separately.
+		With the prefetch stage, the next prefetch_depth chunks of keys are
+		fetched by threads while the first key is processed."""
+		if self.fetchers is None:
+			if keys[0] not in model.prefetched:
+				keys = keys[:self.chunk_size]
+				self.fetched(model, keys, model.fetch(keys, link_models))
+			return
+		
+		inflight = len(set(id(result) for _keys, result in 
+							model.pending.values()))
+		while True: # the chunk of the first key, then the chunks ahead
+			todo = [key for key in keys if key not in model.prefetched and 
+					key not in model.pending][:self.chunk_size]
+			if not todo or todo[0] != keys[0] and (self.exiting or 
+										inflight > self.prefetch_depth):
+				break
+			self.fetchAhead(model, todo, link_models)
+			inflight += 1
+		
+		if keys[0] in model.pending: # wait for the data of the first key
+			done, result = model.pending[keys[0]]
+			for key in done:
+				model.pending.pop(key, None)
+			self.fetched(model, done, result.get())
+	
+	def fetched(self, model, keys, data):
+		"""Keeps the fetched data for process(). Keys without data get None,
+		so they aren't fetched again (process() grabs them itself)."""
+		for key in keys:
+			model.prefetched[key] = data.get(key)
+	
+	def fetchAhead(self, model, keys, link_models):
+		"""Starts fetching the keys in a thread of the prefetch stage."""
+		result = self.fetchers.apply_async(model.fetch, (keys, link_models))
+		for key in keys:
+			model.pending[key] = (keys, result)
 
 	def halt(self):
 		"""Gracefully stop the generation."""
@@ -963,9 +1302,9 @@ class GeneratorThread(QtCore.QThread):
 class TestImdbpy(unittest.TestCase):
 	def test_database(self):
 #		print getImdbpyInstance().getTitlesCount()
-#		print getImdbpyInstance().getPersons()
-#		print getImdbpyInstance().getCompanies()
-#		print getImdbpyInstance().getCharacters()
+#		print next(getImdbpyInstance().iterPersons())
+#		print next(getImdbpyInstance().iterCompanies())
+#		print next(getImdbpyInstance().iterCharacters())
 		pass
 		
 	def test_show_data(self):
@@ -988,11 +1327,90 @@ class TestImdbpy(unittest.TestCase):
 		c = Company()
 		data = getImdbpyInstance().get_company(65570)
 		print c.generatePrologEntity(65570, data)
-	
+
+class TestGeneration(unittest.TestCase):
+	"""A diagram of titles with their cast and directors, generated without
+	the Qt scene from a copy of the test database of imdbdb."""
+
+	def setUp(self):
+		global SQLDB, DBNAME
+		import imdbdb
+		import tempfile
+		self.directory = tempfile.mkdtemp()
+		self.settings = (SQLDB, DBNAME)
+		SQLDB = "sqlite"
+		DBNAME = os.path.join(self.directory, "test.db")
+		imdbdb.memoryDatabase().extract(DBNAME)
+		if hasattr(imdbInstances, 'pid'): # connect to the copy
+			del imdbInstances.pid
+
+	def tearDown(self):
+		global SQLDB, DBNAME
+		import shutil
+		SQLDB, DBNAME = self.settings
+		if hasattr(imdbInstances, 'pid'):
+			del imdbInstances.pid
+		shutil.rmtree(self.directory)
+
+	def models(self):
+		"""The root model and the link models of the diagram"""
+		title = Title()
+		title.guiClassObjects = [Movie(), Series()]
+		person = Person()
+		person.guiClassObjects = [cls() for cls in Person.listSubentities()]
+		for ecm in title.guiClassObjects + person.guiClassObjects:
+			ecm.guiChecked = True
+		link = TitleLinkPerson(title, person)
+		link.guiChecked = {'cast': True, 'director': True, 'producer': False}
+		return title, [link]
+
+	def generate(self, name, processes, amount=5):
+		"""Returns the Prolog of a generation with the amount of processes"""
+		thread = GeneratorThread()
+		thread.processes = processes
+		thread.chunk_size = 2
+		thread.amount = amount
+		thread.random = False
+		thread.output_file = os.path.join(self.directory, name)
+		thread.generateModels(*self.models())
+		with open(thread.output_file) as output:
+			return output.read()
+
+	def test_processes(self):
+		prolog = self.generate("one.pl", 1)
+		self.assertEqual(prolog, self.generate("two.pl", 2))
+		for fact in ("title(t1).", "cast(t1, p1, 1).", "director(t1, p3).",
+					"person(p3)."):
+			self.assertTrue(fact in prolog, fact)
+		self.assertEqual(sorted(os.listdir(self.directory)), ["one.pl",
+				"one.pl.diagram.txt", "test.db", "two.pl", "two.pl.diagram.txt"])
+
+	def test_failure(self):
+		thread = GeneratorThread()
+		thread.processes = 2
+		thread.amount = 5
+		thread.random = False
+		thread.output_file = os.path.join(self.directory, "failed.pl")
+		running = []
+		def fail(rm, giveLinkModels, pool, ahead, writer):
+			running.extend([pool, thread.fetchers, writer])
+			rm.grabIds(2)
+			raise RuntimeError("generation failed")
+		thread.generateEntities = fail
+		title, links = self.models()
+		self.assertRaises(RuntimeError, thread.generateModels, title, links)
+		pool, fetchers, writer = running
+		self.assertEqual(pool._state, multiprocessing.pool.TERMINATE)
+		self.assertEqual(fetchers._state, multiprocessing.pool.TERMINATE)
+		self.assertTrue(thread.fetchers is None)
+		self.assertTrue(writer.out.closed)
+		self.assertTrue(title.idstream is None) # its cursor is closed
+
 # when this file is not imported, but ran directly: run test code
 if __name__ == '__main__':
 	suites = list()
 	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestImdbpy))
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestGeneration))
 	alltests = unittest.TestSuite(suites)
 	
 	unittest.TextTestRunner(verbosity=2).run(alltests)
\ No newline at end of file
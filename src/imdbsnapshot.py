@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# IMDb Relational Dataset Generator
+# Copyright (C) 2012  Jef Van den Brandt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Columnar snapshot of the numeric title attributes: one NumPy .npy file per
+# column, read with memory mapping. The range constraints of all the titles
+# are checked at once with vectorized masks, so only the titles that pass 
+# them are fetched. Build it (again after every imdbpy2sql run) with:
+#   python dbtools.py snapshot
+# NumPy is optional: without it (or without a snapshot) the database
+# selects the ids, see Title.streamIds.
+
+from imdbattr import Constraint, parseRuntime
+from imdb.parser.sql import re_episodes
+from imdb.parser.sql.alchemyadapter import IN
+from sqlalchemy import func
+from sqlalchemy.sql import select
+import threading
+import pickle
+import os
+import unittest
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+MISSING = -1 # no value, or not a number: passes a range like the attributes
+NO_NUMBER = -2 # runtimes, but none of them is a number: fails a range
+
+# column: NumPy type
+columnTypes = [('id', 'int32'), ('kind_id', 'int8'), 
+			('production_year', 'int16'), ('votes', 'int32'), 
+			('rating', 'float32'), ('top_250_rank', 'int16'),
+			('runtime_min', 'int32'), ('runtime_max', 'int32')]
+# imdbpykey of a title attribute: its column
+keyColumns = {'year': 'production_year', 'votes': 'votes', 
+			'rating': 'rating', 'top 250 rank': 'top_250_rank'}
+
+snapshots = {} # the loaded snapshot of each directory
+snapshotLock = threading.Lock()
+
+class Snapshot(object):
+	"""The columns (NumPy arrays) of all the titles, sorted by id.
+	A missing integer is MISSING, a missing rating is NaN."""
+	
+	def __init__(self, columns):
+		self.columns = columns
+		self.ids = columns['id']
+	
+	@classmethod
+	def load(cls, directory, fingerprint):
+		"""The snapshot in the directory, memory mapped. None when there is
+		none, or when it was built for another fingerprint."""
+		try:
+			with open(os.path.join(directory, "fingerprint"), "rb") as f:
+				if pickle.load(f) != fingerprint:
+					return None
+			return cls(dict((name, numpy.load(os.path.join(directory, 
+									name + ".npy"), mmap_mode='r'))
+							for name, _type in columnTypes))
+		except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+			return None
+	
+	def rangeMask(self, key, low, high):
+		"""Titles that pass a range constraint on the attribute with this
+		imdbpykey. None for attributes that aren't in the snapshot."""
+		if key == 'runtimes': # one of the runtimes in the range is enough
+			least = self.columns['runtime_min']
+			most = self.columns['runtime_max']
+			return (least == MISSING) | ((least >= 0) & 
+										(most >= low) & (least <= high))
+		if key not in keyColumns:
+			return None
+		column = self.columns[keyColumns[key]]
+		if key == 'rating': # the attribute compares int(rating)
+			number = numpy.floor(column)
+			with numpy.errstate(invalid='ignore'): # NaN isn't compared
+				inrange = (number >= low) & (number <= high)
+			return numpy.isnan(column) | inrange
+		return (column == MISSING) | ((column >= low) & (column <= high))
+	
+	def mask(self, categories, constraints):
+		"""Titles of the kind ids that pass the enabled constraints. None 
+		when one of them can't be checked with the snapshot (only range 
+		constraints on its columns can)."""
+		mask = numpy.in1d(self.columns['kind_id'], categories)
+		for attr, const in constraints:
+			if not const.enabled:
+				continue
+			if const.type != Constraint.RANGE:
+				return None
+			passing = self.rangeMask(getattr(attr, 'imdbpykey', None),
+									const.curMin, const.curMax)
+			if passing is None:
+				return None
+			mask &= passing
+		return mask
+	
+	def iterIds(self, mask, after=0, chunk=1000, random=False):
+		"""Yields lists of chunk ids of the titles in the mask after the
+		after id (in id order), or in a random order"""
+		ids = self.ids[mask]
+		if random:
+			ids = numpy.random.permutation(ids)
+		else:
+			ids = ids[numpy.searchsorted(ids, after, side='right'):]
+		for start in range(0, len(ids), chunk):
+			yield ids[start:start + chunk].tolist()
+
+def getSnapshot(db, directory):
+	"""The snapshot of the database in the directory, None when NumPy or 
+	an up-to-date snapshot is missing"""
+	if numpy is None:
+		return None
+	fingerprint = db.fingerprint()
+	with snapshotLock:
+		snapshot = snapshots.get(directory)
+		if snapshot is None or snapshot.fingerprint != fingerprint:
+			snapshot = Snapshot.load(directory, fingerprint)
+			if snapshot is not None:
+				snapshot.fingerprint = fingerprint
+				snapshots[directory] = snapshot
+	return snapshot
+
+def streamIds(db, directory, categories, constraints, after=0, chunk=1000,
+			random=False):
+	"""Title ids like iterTitles, selected with the snapshot in the 
+	directory. None when the snapshot can't be used (see Snapshot.mask)."""
+	snapshot = getSnapshot(db, directory)
+	if snapshot is None:
+		return None
+	mask = snapshot.mask(categories, constraints)
+	if mask is None:
+		return None
+	return snapshot.iterIds(mask, after, chunk, random)
+
+def number(text, convert=int):
+	try:
+		return convert(text)
+	except ValueError:
+		return None
+
+def buildSnapshot(db, directory, window=10000):
+	"""Writes the columns of all the titles to the directory. The values
+	are read like IMDbPY does (the first row of an info type).
+	Returns the amount of titles."""
+	if numpy is None:
+		raise ImportError("The snapshot needs NumPy.")
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	fingerprintFile = os.path.join(directory, "fingerprint")
+	if os.path.exists(fingerprintFile): # invalid until it is built
+		os.remove(fingerprintFile)
+	fingerprint = db.fingerprint()
+	
+	T = db.Q['Title']
+	types = {} # info type id: (table, imdbpykey)
+	for key in ('votes', 'rating', 'top 250 rank', 'runtimes'):
+		if key in db._infoRev:
+			types[db._infoRev[key]] = (db.infoTable(key), key)
+	values = dict((name, []) for name, _type in columnTypes)
+	maxid = select([func.max(T.q.id)]).execute().scalar() or 0
+	for start in range(0, maxid + 1, window):
+		end = start + window - 1
+		info = {} # title id: {imdbpykey: [info,...]}
+		for table in set([table for table, _key in types.values()]):
+			query = select([table.q.movieID, table.q.infoTypeID, 
+							table.q.info])
+			query = query.where(IN(table.q.infoTypeID, types.keys()))
+			query = query.where(table.q.movieID.between(start, end))
+			for mid, infotype, text in query.order_by(table.q.id).execute():
+				key = types[infotype][1]
+				info.setdefault(mid, {}).setdefault(key, []).append(text)
+		
+		query = select([T.q.id, T.q.kindID, T.q.productionYear])
+		query = query.where(T.q.id.between(start, end)).order_by(T.q.id)
+		for tid, kind, year in query.execute():
+			data = info.get(tid, {})
+			values['id'].append(tid)
+			values['kind_id'].append(kind)
+			values['production_year'].append(MISSING if year is None 
+											else year)
+			for key, column in keyColumns.items():
+				if key == 'year':
+					continue
+				convert = float if key == 'rating' else int
+				value = None
+				if key in data:
+					value = number(data[key][0], convert)
+				if value is None:
+					value = float('nan') if key == 'rating' else MISSING
+				values[column].append(value)
+			
+			runtimes = []
+			for i, text in enumerate(data.get('runtimes', [])):
+				if i == 0: # IMDbPY strips the episodes of the first one
+					text = re_episodes.sub('', text)
+				runtime = number(parseRuntime(text)[0])
+				if runtime is not None:
+					runtimes.append(runtime)
+			if 'runtimes' not in data:
+				least = most = MISSING
+			elif not len(runtimes):
+				least = most = NO_NUMBER
+			else:
+				least, most = min(runtimes), max(runtimes)
+			values['runtime_min'].append(least)
+			values['runtime_max'].append(most)
+	
+	for name, numpyType in columnTypes:
+		numpy.save(os.path.join(directory, name + ".npy"),
+				numpy.array(values[name], dtype=numpyType))
+	with open(fingerprintFile, "wb") as f:
+		pickle.dump(fingerprint, f, pickle.HIGHEST_PROTOCOL)
+	with snapshotLock:
+		snapshots.pop(directory, None)
+	return len(values['id'])
+
+###############################################################################
+## Some tests #################################################################
+###############################################################################
+
+class TestSnapshot(unittest.TestCase):
+	def setUp(self):
+		if numpy is None:
+			self.skipTest("NumPy is not installed")
+		nan = float('nan')
+		columns = {'id': [1, 2, 3, 4, 5],
+				'kind_id': [1, 1, 2, 1, 1],
+				'production_year': [1990, MISSING, 2000, 1950, 2010],
+				'votes': [10, 500, MISSING, 50, 5000],
+				'rating': [7.9, nan, 5.0, 8.0, 6.5],
+				'top_250_rank': [MISSING] * 5,
+				'runtime_min': [90, MISSING, NO_NUMBER, 30, 100],
+				'runtime_max': [120, MISSING, NO_NUMBER, 200, 100]}
+		self.snapshot = Snapshot(dict((name, numpy.array(columns[name], 
+													dtype=numpyType))
+									for name, numpyType in columnTypes))
+	
+	def ids(self, mask):
+		return self.snapshot.ids[mask].tolist()
+	
+	def test_ranges(self):
+		s = self.snapshot
+		# titles without a year pass
+		self.assertEqual(self.ids(s.rangeMask('year', 1960, 2000)), [1, 2, 3])
+		self.assertEqual(self.ids(s.rangeMask('votes', 100, 1000)), [2, 3])
+		# int(rating) is compared
+		self.assertEqual(self.ids(s.rangeMask('rating', 7, 7)), [1, 2])
+		# one runtime in the range is enough, no number fails
+		self.assertEqual(self.ids(s.rangeMask('runtimes', 150, 300)), [2, 4])
+		self.assertEqual(s.rangeMask('series years', 1, 2), None)
+	
+	def test_mask(self):
+		class Attr(object):
+			def __init__(self, key):
+				self.imdbpykey = key
+		class Range(object):
+			type = Constraint.RANGE
+			enabled = True
+			curMin, curMax = 1960, 2000
+		class Values(Range):
+			type = Constraint.VALUES
+		s = self.snapshot
+		self.assertEqual(self.ids(s.mask([1], [])), [1, 2, 4, 5])
+		self.assertEqual(self.ids(s.mask([1, 2], [(Attr('year'), 
+												Range())])), [1, 2, 3])
+		self.assertEqual(s.mask([1], [(Attr('genres'), Values())]), None)
+		
+	def test_ids(self):
+		s = self.snapshot
+		mask = s.mask([1, 2], [])
+		self.assertEqual(list(s.iterIds(mask, after=2, chunk=2)), 
+						[[3, 4], [5]])
+		ids = sum(s.iterIds(mask, chunk=2, random=True), [])
+		self.assertEqual(sorted(ids), [1, 2, 3, 4, 5])
+
+# when this file is not imported, but ran directly: run test code
+if __name__ == '__main__':
+	suites = list()
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestSnapshot))
+	alltests = unittest.TestSuite(suites)
+	
+	unittest.TextTestRunner(verbosity=2).run(alltests)
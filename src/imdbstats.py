@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# IMDb Relational Dataset Generator
+# Copyright (C) 2012  Jef Van den Brandt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Statistics of the attribute values of the titles: histograms of the
+# numeric attributes and frequency tables of the categorical ones, made with
+# SQL aggregates. estimateSelectivity() uses them to estimate the share of 
+# the entities that passes the constraints, before anything is fetched.
+# The statistics are kept in statsFile until the database changes.
+
+from imdbattr import Constraint, parseRuntime, parseBudget
+import imdbdb
+import threading
+import unittest
+import math
+
+statsFile = "stats.imdb"
+statistics = {} # the statistics of each database fingerprint
+statsLock = threading.Lock()
+
+# numeric title attributes: the number in a value (like getValue(s) of the
+# attribute does it)
+numericKeys = {'year': int,
+			'votes': int,
+			'rating': lambda text: int(float(text)), # int(rating) is checked
+			'top 250 rank': int,
+			'runtimes': lambda text: int(parseRuntime(text)[0]),
+			'budget': lambda text: int(parseBudget(text)[0])}
+# a title can have more of these numbers (RangeConstraintMultiple)
+multipleKeys = ('runtimes', 'budget')
+# categorical title attributes
+categoricalKeys = ('genres', 'countries', 'languages', 'color info', 
+				'certificates')
+
+class Histogram(object):
+	"""Equi-depth histogram of the numbers of an attribute: every bucket
+	holds about the same amount of titles.
+	entities: amount of titles with the attribute
+	others: titles with a value that isn't a number (they pass a range)"""
+	
+	def __init__(self, frequencies, entities, others=0, buckets=64):
+		self.entities = entities
+		self.others = others
+		self.buckets = [] # [lowest number, highest number, amount]
+		depth = sum(frequencies.values()) / float(buckets)
+		for number, amount in sorted(frequencies.items()):
+			if len(self.buckets) and self.buckets[-1][2] < depth:
+				self.buckets[-1][1] = number
+				self.buckets[-1][2] += amount
+			else:
+				self.buckets.append([number, number, amount])
+	
+	def amount(self, low, high):
+		"""Estimated amount of numbers in [low, high], they are spread 
+		evenly over the whole numbers of a bucket."""
+		result = 0.0
+		for first, last, amount in self.buckets:
+			if last < low or first > high:
+				continue
+			if low <= first and last <= high:
+				result += amount
+			else:
+				inside = min(high, last) - max(low, first) + 1
+				result += amount * max(inside, 0) / float(last - first + 1)
+		return result
+	
+	def fraction(self, low, high):
+		"""Share of the titles with the attribute that pass the range"""
+		if not self.entities:
+			return 1.0
+		return min(1.0, (self.amount(low, high) + self.others) / 
+					float(self.entities))
+
+class Frequencies(object):
+	"""Frequency table of the values of a categorical attribute.
+	entities: amount of titles with the attribute"""
+	
+	def __init__(self, frequencies, entities):
+		self.frequencies = frequencies
+		self.entities = entities
+	
+	def fraction(self, values):
+		"""Share of the titles with the attribute that have one of the 
+		values (the values of a title are taken as independent)"""
+		if not self.entities:
+			return 1.0
+		missing = 1.0
+		for value in values:
+			share = self.frequencies.get(value, 0) / float(self.entities)
+			missing *= 1.0 - min(share, 1.0)
+		return 1.0 - missing
+
+def buildStatistics(db):
+	"""Histograms and frequency tables of the title attributes, by their
+	imdbpykey. Every attribute is one GROUP BY over its values."""
+	stats = {}
+	for key, number in numericKeys.items():
+		frequencies = {}
+		others = 0
+		for text, amount in db.valueFrequencies(key).items():
+			try:
+				value = number(text)
+			except (ValueError, NameError): # budget without digits
+				if key not in multipleKeys:
+					others += amount
+				continue
+			frequencies[value] = frequencies.get(value, 0) + amount
+		if key == 'year':
+			entities = sum(frequencies.values())
+		else:
+			entities = db.getAvailableCount(key)
+		stats[key] = Histogram(frequencies, entities, others)
+	for key in categoricalKeys:
+		stats[key] = Frequencies(db.valueFrequencies(key, noted=False), 
+								db.getAvailableCount(key))
+	return stats
+
+def getStatistics(db, build=True):
+	"""The statistics of the database, built once (see buildStatistics)
+	build: False returns None instead of building them"""
+	fingerprint = db.fingerprint()
+	with statsLock:
+		stats = statistics.get(fingerprint)
+		if stats is None:
+			stats = imdbdb.loadCatalog(fingerprint, statsFile)
+		if stats is None:
+			if not build:
+				return None
+			stats = buildStatistics(db)
+			imdbdb.saveCatalog(fingerprint, stats, statsFile)
+		statistics[fingerprint] = stats
+	return stats
+
+def attributeSelectivity(attr, stats, available, checked=()):
+	"""Share of the entities that pass the enabled constraints of the 
+	attribute. Constraints without statistics let everything through.
+	available: share of the entities that have the attribute
+	checked: constraints the id query already checked, the entities it
+	returns pass them"""
+	key = getattr(attr, 'imdbpykey', None)
+	required = False
+	passing = 1.0 # share of the entities with the attribute that pass
+	for const in attr.constraints:
+		if not const.enabled:
+			continue
+		if const.type == Constraint.AVAILABILITY:
+			required = True
+			if const in checked: # all the returned entities have it
+				available = 1.0
+		elif const in checked:
+			continue
+		elif const.type == Constraint.RANGE and key in numericKeys \
+				and key in stats:
+			passing *= stats[key].fraction(const.curMin, const.curMax)
+		elif const.type == Constraint.VALUES and key in categoricalKeys \
+				and key in stats:
+			passing *= stats[key].fraction([v for v, checked in 
+										const.values.items() if checked])
+	if required:
+		return available * passing
+	# entities without the attribute pass range and value constraints
+	return (1.0 - available) + available * passing
+
+def estimateSelectivity(entity_model, db=None, build=True, checked=()):
+	"""Estimated share (0-1) of the entities of the model that pass the
+	constraints of its attributes. The attributes are taken as independent.
+	Only the title attributes have statistics, the other entities just use
+	the availability of their attributes.
+	build: False returns None when the count catalog or the statistics 
+	still have to be made
+	checked: (attribute, constraint) pairs the id query already checks 
+	(see checkedConstraints of imdbdb), they are left out of the estimate"""
+	from imdbmodel import getImdbpyInstance, Title, Person
+	if db is None:
+		db = getImdbpyInstance()
+	if not True in [c.enabled for attr in entity_model.attributes
+												for c in attr.constraints]:
+		return 1.0
+	stats = {}
+	counts = db.counts(build)
+	if counts is None:
+		return None
+	if isinstance(entity_model, Title):
+		stats = getStatistics(db, build)
+		if stats is None:
+			return None
+		total = float(sum(counts['titles'].values()))
+		def availability(key):
+			if key == 'year':
+				amount = stats['year'].entities
+			else:
+				amount = db.getAvailableCount(key)
+			if amount is None or not total:
+				return 1.0
+			return min(1.0, amount / total)
+	elif isinstance(entity_model, Person):
+		total = float(counts['all persons'])
+		def availability(key):
+			if key not in db._infoRev or not total:
+				return 1.0
+			amount = counts['person info'].get(db._infoRev[key], 0)
+			return min(1.0, amount / total)
+	else:
+		availability = lambda key: 1.0
+	
+	checked = set(const for _attr, const in checked)
+	selectivity = 1.0
+	for attr in entity_model.attributes:
+		selectivity *= attributeSelectivity(attr, stats, 
+							availability(getattr(attr, 'imdbpykey', None)),
+							checked)
+	return selectivity
+
+def batchSize(entity_model, amount, db=None, minimum=0.001, build=True,
+			checked=()):
+	"""About how many ids need to be fetched for the given amount of 
+	entities that pass the constraints (None when there is no estimate,
+	see estimateSelectivity). Only the constraints that aren't checked 
+	by the id query count."""
+	selectivity = estimateSelectivity(entity_model, db, build, checked)
+	if selectivity is None:
+		return None
+	return int(math.ceil(amount / max(selectivity, minimum)))
+
+###############################################################################
+## Some tests #################################################################
+###############################################################################
+
+class TestStatistics(unittest.TestCase):
+	def test_histogram(self):
+		# 100 titles with 1..10 votes, 10 titles each
+		h = Histogram(dict((n, 10) for n in range(1, 11)), 100, buckets=5)
+		self.assertEqual(len(h.buckets), 5)
+		self.assertEqual(h.amount(1, 10), 100)
+		self.assertEqual(h.amount(3, 4), 20)
+		self.assertEqual(h.amount(11, 20), 0)
+		self.assertAlmostEqual(h.fraction(1, 5), 0.5)
+		self.assertAlmostEqual(h.fraction(0, 1000), 1.0)
+		
+		# partial bucket: numbers 1 and 11 in one bucket
+		h = Histogram({1: 50, 11: 50}, 100, buckets=1)
+		self.assertAlmostEqual(h.amount(1, 6), 100 * 6 / 11.0)
+		
+		# values that are no number pass
+		h = Histogram({5: 10}, 20, others=10)
+		self.assertAlmostEqual(h.fraction(1, 2), 0.5)
+		self.assertAlmostEqual(h.fraction(1, 5), 1.0)
+		
+		self.assertEqual(Histogram({}, 0).fraction(1, 2), 1.0)
+	
+	def test_frequencies(self):
+		f = Frequencies({'Drama': 50, 'Comedy': 20, 'Short': 10}, 100)
+		self.assertAlmostEqual(f.fraction(['Drama']), 0.5)
+		self.assertAlmostEqual(f.fraction(['Drama', 'Comedy']), 0.6)
+		self.assertAlmostEqual(f.fraction(['Western']), 0.0)
+		self.assertAlmostEqual(f.fraction([]), 0.0)
+
+	def test_checked_constraints(self):
+		from imdbattr import AvailabilityConstraintBase, RangeConstraint
+		class Votes(object):
+			imdbpykey = 'votes'
+		attr = Votes()
+		available = AvailabilityConstraintBase(enabled=True)
+		votes = RangeConstraint(1, 20, enabled=True)
+		votes.curMax = 10
+		attr.constraints = [available, votes]
+		stats = {'votes': Histogram(dict((n, 10) for n in range(1, 21)), 200)}
+		# 40% has votes, half of them 1-10
+		self.assertAlmostEqual(attributeSelectivity(attr, stats, 0.4), 0.2)
+		# the id query only returns titles with votes / in the range
+		self.assertAlmostEqual(attributeSelectivity(attr, stats, 0.4,
+												set([available])), 0.5)
+		self.assertAlmostEqual(attributeSelectivity(attr, stats, 0.4,
+												set([votes])), 0.4)
+		self.assertAlmostEqual(attributeSelectivity(attr, stats, 0.4,
+										set([available, votes])), 1.0)
+
+	def test_parse_numbers(self):
+		self.assertEqual(numericKeys['rating']('7.9'), 7)
+		self.assertEqual(numericKeys['runtimes']('USA:120::(cut)'), 120)
+		self.assertEqual(numericKeys['budget']('$1,000 (estimated)'), 1000)
+		self.assertRaises(NameError, numericKeys['budget'], 'unknown')
+		self.assertRaises(ValueError, numericKeys['runtimes'], 'USA:?')
+
+# when this file is not imported, but ran directly: run test code
+if __name__ == '__main__':
+	suites = list()
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestStatistics))
+	alltests = unittest.TestSuite(suites)
+	
+	unittest.TextTestRunner(verbosity=2).run(alltests)
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# IMDb Relational Dataset Generator
+# Copyright (C) 2012  Jef Van den Brandt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Writes the Prolog of a generation run to one open file. The facts are
+# kept in a buffer and encoded together when it is flushed: when it is
+# bigger than buffer_size characters or older than flush_interval seconds.
+# With threaded=True the flushed blocks go to a writer thread through a
+# bounded queue, so a slow disk doesn't stop the database fetches.
+
+import threading
+import Queue
+import time
+import tempfile
+import os
+import unittest
+
+class PrologWriter(object):
+
+	def __init__(self, filename, mode="w", buffer_size=1 << 20,
+				flush_interval=5, threaded=False, queue_size=8):
+		self.filename = filename
+		self.out = open(filename, mode + "b")
+		self.buffer_size = buffer_size
+		self.flush_interval = flush_interval
+		self.pieces = [] # text not encoded yet
+		self.size = 0 # characters in pieces
+		self.flushed = time.time()
+		self.error = None # exception of the writer thread
+		self.queue = None
+		if threaded:
+			self.queue = Queue.Queue(queue_size)
+			self.thread = threading.Thread(target=self.writeBlocks,
+										name="PrologWriter")
+			self.thread.daemon = True
+			self.thread.start()
+
+	def write(self, text):
+		"""Adds the text (str or unicode) to the buffer. Characters that are
+		not ascii become '?'."""
+		self.pieces.append(text)
+		self.size += len(text)
+		if (self.size >= self.buffer_size or
+				time.time() - self.flushed >= self.flush_interval):
+			self.flush()
+
+	def flush(self):
+		"""Encodes the buffer and writes it (or gives it to the thread)."""
+		self.flushed = time.time()
+		if self.error is not None:
+			raise self.error
+		if not self.pieces:
+			return
+		block = u"".join(self.pieces).encode("ascii", "replace")
+		self.pieces = []
+		self.size = 0
+		if self.queue is None:
+			self.out.write(block)
+			self.out.flush()
+		else:
+			self.queue.put(block) # waits when the thread is behind
+
+	def writeBlocks(self):
+		"""Writer thread: writes the blocks of the queue until None."""
+		while True:
+			block = self.queue.get()
+			if block is None:
+				break
+			if self.error is None:
+				try:
+					self.out.write(block)
+					self.out.flush()
+				except Exception as e: # raised by the next flush
+					self.error = e
+
+	def close(self):
+		"""Writes everything that is left and closes the file."""
+		if self.out.closed:
+			return
+		try:
+			self.flush()
+		finally:
+			if self.queue is not None:
+				self.queue.put(None)
+				self.thread.join()
+			self.out.close()
+		if self.error is not None:
+			raise self.error
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+###############################################################################
+## Some tests #################################################################
+###############################################################################
+
+class TestPrologWriter(unittest.TestCase):
+	def setUp(self):
+		handle, self.filename = tempfile.mkstemp(suffix=".pl")
+		os.close(handle)
+
+	def tearDown(self):
+		os.remove(self.filename)
+
+	def read(self):
+		with open(self.filename, "rb") as f:
+			return f.read()
+
+	def test_buffer(self):
+		writer = PrologWriter(self.filename, buffer_size=20)
+		writer.write("title(t1).\n")
+		self.assertEqual(self.read(), "") # not full yet
+		writer.write(u"name(p1, 'Bj\xf6rk').\n")
+		self.assertEqual(self.read(), "title(t1).\nname(p1, 'Bj?rk').\n")
+		writer.write("end.\n")
+		writer.close()
+		self.assertEqual(self.read(), 
+						"title(t1).\nname(p1, 'Bj?rk').\nend.\n")
+
+	def test_append(self):
+		with PrologWriter(self.filename) as writer:
+			writer.write("a.\n")
+		with PrologWriter(self.filename, "a", threaded=True,
+						queue_size=1) as writer:
+			for i in range(100):
+				writer.write("b(%d).\n" % i)
+				writer.flush()
+		self.assertEqual(self.read(), "a.\n" +
+						"".join("b(%d).\n" % i for i in range(100)))
+
+# when this file is not imported, but ran directly: run test code
+if __name__ == '__main__':
+	suites = list()
+	suites.append(unittest.TestLoader().loadTestsFromTestCase(TestPrologWriter))
+	alltests = unittest.TestSuite(suites)
+
+	unittest.TextTestRunner(verbosity=2).run(alltests)